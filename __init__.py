@@ -1,3 +1,91 @@
-from cpm_tools.visualization_2d import *
-from cpm_tools.visualization_2d_mpl import *
-from cpm_tools.initialization import *
\ No newline at end of file
+"""
+Tools for initializing, analyzing and visualizing CPM simulations.
+
+Submodules and their functions are imported on first use (PEP 562), so importing cpm_tools is cheap and a script
+that only seeds a grid does not pull in matplotlib, PIL or imageio. All public names are available directly from
+the package, e.g. ``from cpm_tools import seed_cells``.
+"""
+import importlib
+
+# public name -> submodule that defines it
+_EXPORTS = {
+    'get_2d_projection': 'visualization_2d',
+    'draw_2d_projection': 'visualization_2d',
+    'get_2d_projections': 'visualization_2d',
+    'draw_3d_montage': 'visualization_2d',
+    'draw_cpm_grid': 'visualization_2d',
+    'draw_cpm_grids': 'visualization_2d',
+    'draw_cpm_grid_tiled': 'visualization_2d',
+    'Canvas': 'visualization_2d',
+    'add_text': 'visualization_2d',
+    'add_box': 'visualization_2d',
+    'add_text_outside': 'visualization_2d',
+    'add_legend': 'visualization_2d',
+    'add_color_bar': 'visualization_2d',
+    'animate_cpm_sim_mpl': 'visualization_2d_mpl',
+    'stream_cpm_sim_mpl': 'visualization_2d_mpl',
+    'draw_cpm_grid_mpl': 'visualization_2d_mpl',
+    'LiveViewer': 'visualization_2d_mpl',
+    'grow_cells_DLA': 'initialization',
+    'grow_cells_round': 'initialization',
+    'grow_cells_confluent': 'initialization',
+    'seed_cells': 'initialization',
+    'seed_cells_3d': 'initialization',
+    'initialize_batch': 'initialization',
+    'write_to_tiff': 'initialization',
+    'SnapshotStore': 'snapshots',
+    'DeltaTrajectory': 'snapshots',
+    'iter_frame_directory': 'snapshots',
+    'load_frame_directory': 'snapshots',
+    'cell_statistics': 'analysis',
+    'contact_matrix': 'analysis',
+    'IncrementalAnalyzer': 'analysis',
+    'analyze_trajectory': 'analysis',
+}
+
+_SUBMODULES = ('visualization_2d', 'visualization_2d_mpl', 'initialization', 'snapshots', 'analysis')
+
+__all__ = sorted(_EXPORTS) + ['warmup']
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('cpm_tools.' + name)
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module('cpm_tools.' + _EXPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
+
+
+def warmup():
+    """
+    Compile all numba kernels by running the initialization and analysis functions on small grids.
+
+    Compiled kernels are cached on disk, so calling this once (e.g. after installation, or before starting a
+    pool of worker processes) removes the compilation time from all later processes.
+    """
+    import warnings
+    import numpy as np
+    from cpm_tools import initialization, analysis
+    # kernels are compiled for the grid dtypes that seed_cells produces
+    for dtype in (np.uint16, np.uint32):
+        for shape in ((20, 20), (12, 12, 12)):
+            # few seeds are placed by dart throwing, many by packing the grid, which warns that not all fit
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                initialization._seed_cells_poisson(shape, 100, 2, 4, 30, np.random.default_rng(0), dtype)
+            seeds = initialization._seed_cells_poisson(shape, 4, 2, 4, 30, np.random.default_rng(0), dtype)
+            initialization._seed_cells_naive(shape, 4, 2, np.random.default_rng(0), dtype)
+            initialization.grow_cells_round(seeds.copy(), 2)
+            initialization.grow_cells_DLA(seeds, 10, rng=0, method='checkerboard')
+            grid = initialization.grow_cells_DLA(seeds, 10, rng=0)
+            try:
+                initialization.grow_cells_confluent(seeds, 10)
+            except ImportError:
+                pass
+            analysis.cell_statistics(grid, grid % 2)
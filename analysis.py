@@ -0,0 +1,373 @@
+import numpy as np
+from numba import jit
+
+from cpm_tools.initialization import _as_3d, _moore_offsets
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+# column in the moments array for each pair of axes
+_MOMENT = ((0, 1, 2), (1, 3, 4), (2, 4, 5))
+
+
+def cell_statistics(sigma, tau=None):
+    """
+    Compute the morphology of all cells in a 2D or 3D CPM grid in a single pass over the grid.
+
+    The perimeter is the number of (von Neumann) pixel faces of a cell that border another cell,
+    the medium or the edge of the lattice. Orientation and elongation follow from the second moments
+    of the cell, where each pixel is treated as a unit square (cube): the orientation is the unit vector
+    along the major axis and the elongation is the ratio between the major and the minor axis length.
+
+    Args:
+        sigma: CPM grid with cell ids (0 is the medium)
+        tau: grid with cell types (optional)
+
+    Returns: dictionary with one array per statistic and one entry per cell, sorted by cell id:
+        id, volume, perimeter, centroid (n x ndim), bbox (n x 2*ndim, minimum followed by maximum
+        coordinates, inclusive), orientation (n x ndim), elongation and, when tau is given, type
+
+    """
+    ndim = sigma.ndim
+    sigma3d = np.ascontiguousarray(sigma).reshape(_as_3d(sigma.shape))
+    if tau is None:
+        tau3d = np.zeros((1, 1, 1), dtype=np.int64)
+    else:
+        tau3d = np.ascontiguousarray(tau).reshape(sigma3d.shape)
+    n = int(sigma3d.max()) + 1 if sigma3d.size > 0 else 1
+    volume, perimeter, sums, moments, bbox, types = _cell_sums(sigma3d, tau3d, n, ndim)
+    ids = np.flatnonzero(volume)
+    ids = ids[ids > 0]
+    volume = volume[ids]
+    v = volume[:, None].astype(np.float64)
+    centroid = sums[ids, :ndim] / v
+    # covariance matrix; the 1/12 is the variance of a unit pixel along each axis
+    cov = np.empty((len(ids), ndim, ndim))
+    for i in range(ndim):
+        for j in range(i, ndim):
+            cov[:, i, j] = cov[:, j, i] = moments[ids, _MOMENT[i][j]] / volume - centroid[:, i] * centroid[:, j]
+    cov[:, range(ndim), range(ndim)] += 1.0 / 12
+    eigval, eigvec = np.linalg.eigh(cov)
+    stats = {'id': ids,
+             'volume': volume,
+             'perimeter': perimeter[ids],
+             'centroid': centroid,
+             'bbox': np.concatenate((bbox[ids, :ndim], bbox[ids, 3:3 + ndim]), axis=1),
+             'orientation': eigvec[:, :, -1],
+             'elongation': np.sqrt(eigval[:, -1] / eigval[:, 0])}
+    if tau is not None:
+        stats['type'] = types[ids]
+    return stats
+
+
+def contact_matrix(sigma, tau=None, neighbourhood='moore', by_type=False):
+    """
+    Compute the contact graph of a 2D or 3D CPM grid.
+
+    Each pair of neighbouring pixels that belong to different cells (including the medium, id 0)
+    counts as one unit of contact between these cells. Pairs are found by comparing the grid with
+    shifted copies of itself, such that every pixel pair is visited exactly once.
+
+    Args:
+        sigma: CPM grid with cell ids
+        tau: grid with cell types, required when by_type is True
+        neighbourhood: 'moore' (8 or 26 neighbours) or 'von_neumann' (4 or 6 neighbours)
+        by_type: aggregate the contacts by cell type
+
+    Returns: symmetric scipy.sparse CSR matrix with the contact counts between cells, indexed by cell id
+        (or by cell type when by_type is True). With by_type, contacts between different cells of the
+        same type are counted once on the diagonal.
+
+    """
+    if sparse is None:
+        raise ImportError('contact_matrix requires scipy')
+    if by_type and tau is None:
+        raise ValueError('tau is required to aggregate contacts by type')
+    labels = np.asarray(tau if by_type else sigma)
+    n = int(labels.max()) + 1 if labels.size > 0 else 1
+    rows, cols, data = _contact_counts(np.asarray(sigma), labels, _half_offsets(sigma.ndim, neighbourhood))
+    # add both directions, except for the diagonal
+    off_diagonal = rows != cols
+    data = np.concatenate((data, data[off_diagonal]))
+    rows, cols = np.concatenate((rows, cols[off_diagonal])), np.concatenate((cols, rows[off_diagonal]))
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+
+class IncrementalAnalyzer(object):
+    """
+    Keep track of cell volumes, perimeters, centroids and contacts over a simulation, by updating them from
+    the pixels that changed between consecutive frames instead of re-analyzing each frame.
+
+    Only the changed pixels and the pixel pairs they are part of are visited in an update, so the cost of an
+    update scales with the number of changed pixels rather than with the size of the grid. Perimeters follow
+    the definition of cell_statistics and contacts follow the definition of contact_matrix.
+
+    Args:
+        sigma: CPM grid with cell ids of the first frame
+        tau: grid with cell types of the first frame (optional)
+        neighbourhood: neighbourhood used for the contacts, 'moore' or 'von_neumann'
+
+    """
+
+    def __init__(self, sigma, tau=None, neighbourhood='moore'):
+        sigma = np.asarray(sigma)
+        self.shape = sigma.shape
+        self.ndim = sigma.ndim
+        half = _half_offsets(self.ndim, neighbourhood)
+        # padded copy of the grid with a border of -1, such that neighbours never fall outside of the grid
+        pad = ((1, 1),) * self.ndim + ((0, 0),) * (3 - self.ndim)
+        self._sigma = np.pad(sigma.reshape(_as_3d(self.shape)).astype(np.int64), pad, constant_values=-1).ravel()
+        self._padded = tuple(n + 2 if i < self.ndim else n for i, n in enumerate(_as_3d(self.shape)))
+        strides = np.array([self._padded[1] * self._padded[2], self._padded[2], 1])
+        full = half + [tuple(-k for k in o) for o in half]
+        self._offsets = np.array([np.dot(o, strides[:self.ndim]) for o in full], dtype=np.int64)
+        self._faces = np.array([sum(map(abs, o)) == 1 for o in full])
+        self._strides = strides
+        # per cell statistics
+        stats = cell_statistics(sigma, tau)
+        n = int(sigma.max()) + 1 if sigma.size > 0 else 1
+        self.volume = np.zeros(n, dtype=np.int64)
+        self.perimeter = np.zeros(n, dtype=np.int64)
+        self.sums = np.zeros((n, 3))
+        self.types = None if tau is None else np.zeros(n, dtype=np.asarray(tau).dtype)
+        self.volume[stats['id']] = stats['volume']
+        self.volume[0] = np.count_nonzero(sigma == 0)
+        self.perimeter[stats['id']] = stats['perimeter']
+        self.sums[stats['id'], :self.ndim] = stats['centroid'] * stats['volume'][:, None]
+        if tau is not None:
+            self.types[stats['id']] = stats['type']
+        rows, cols, counts = _contact_counts(sigma, sigma, half)
+        self.contacts = dict(zip(zip(rows.tolist(), cols.tolist()), counts.tolist()))
+        self._records = []
+
+    def _resize(self, n):
+        if n <= len(self.volume):
+            return
+        self.volume = np.concatenate((self.volume, np.zeros(n - len(self.volume), dtype=np.int64)))
+        self.perimeter = np.concatenate((self.perimeter, np.zeros(n - len(self.perimeter), dtype=np.int64)))
+        self.sums = np.concatenate((self.sums, np.zeros((n - len(self.sums), 3))))
+        if self.types is not None:
+            self.types = np.concatenate((self.types, np.zeros(n - len(self.types), dtype=self.types.dtype)))
+
+    def update(self, sigma, tau=None):
+        """
+        Update the statistics to a new frame by comparing it with the current frame.
+
+        Args:
+            sigma: CPM grid with cell ids of the new frame
+            tau: grid with cell types of the new frame (optional)
+
+        """
+        sigma = np.asarray(sigma)
+        current = self._sigma.reshape(self._padded)[tuple(slice(1, -1) if i < self.ndim else slice(None)
+                                                          for i in range(3))]
+        index = np.flatnonzero(current.reshape(self.shape) != sigma)
+        self.apply_changes(index, sigma.ravel()[index], None if tau is None else np.asarray(tau).ravel()[index])
+
+    def apply_changes(self, index, new_sigma, new_tau=None):
+        """
+        Update the statistics from a list of changed pixels, e.g. as given by DeltaTrajectory.changes.
+
+        Args:
+            index: flat indices of the changed pixels
+            new_sigma: new cell ids of the changed pixels
+            new_tau: new cell types of the changed pixels (optional)
+
+        """
+        new_sigma = np.asarray(new_sigma, dtype=np.int64)
+        if len(new_sigma) > 0:
+            self._resize(int(new_sigma.max()) + 1)
+        if new_tau is not None and self.types is not None:
+            self.types[new_sigma] = new_tau
+        coords = np.array(np.unravel_index(np.asarray(index, dtype=np.int64), self.shape))
+        pixels = np.dot(self._strides[:self.ndim], coords + 1)
+        keep = new_sigma != self._sigma[pixels]
+        pixels, new_sigma, coords = pixels[keep], new_sigma[keep], coords[:, keep]
+        if len(pixels) == 0:
+            return
+        # all pixel pairs that contain a changed pixel, each pair once
+        p = np.repeat(pixels, len(self._offsets))
+        q = (pixels[:, None] + self._offsets[None, :]).ravel()
+        faces = np.tile(self._faces, len(pixels))
+        size = len(self._sigma)
+        keys, first = np.unique(np.minimum(p, q) * size + np.maximum(p, q), return_index=True)
+        a, b, faces = keys // size, keys % size, faces[first]
+        self._pairs(a, b, faces, -1)
+        old = self._sigma[pixels]
+        np.add.at(self.volume, old, -1)
+        np.add.at(self.volume, new_sigma, 1)
+        for i in range(self.ndim):
+            np.add.at(self.sums[:, i], old, -coords[i])
+            np.add.at(self.sums[:, i], new_sigma, coords[i])
+        self._sigma[pixels] = new_sigma
+        self._pairs(a, b, faces, 1)
+
+    def _pairs(self, a, b, faces, sign):
+        """ Add (sign 1) or remove (sign -1) the contribution of the pixel pairs a, b """
+        la = self._sigma[a]
+        lb = self._sigma[b]
+        diff = la != lb
+        for l in (la[faces & diff], lb[faces & diff]):
+            np.add.at(self.perimeter, l[l > 0], sign)
+        contact = diff & (la >= 0) & (lb >= 0)
+        rows, cols = np.minimum(la[contact], lb[contact]), np.maximum(la[contact], lb[contact])
+        n = len(self.volume)
+        keys, counts = np.unique(rows * n + cols, return_counts=True)
+        for key, count in zip(zip((keys // n).tolist(), (keys % n).tolist()), (sign * counts).tolist()):
+            count += self.contacts.get(key, 0)
+            if count:
+                self.contacts[key] = count
+            else:
+                del self.contacts[key]
+
+    def statistics(self):
+        """
+        Current statistics of all cells.
+
+        Returns: dictionary with arrays id, volume, perimeter, centroid and, when tau is given, type
+
+        """
+        ids = np.flatnonzero(self.volume)
+        ids = ids[ids > 0]
+        stats = {'id': ids,
+                 'volume': self.volume[ids],
+                 'perimeter': self.perimeter[ids],
+                 'centroid': self.sums[ids, :self.ndim] / self.volume[ids, None]}
+        if self.types is not None:
+            stats['type'] = self.types[ids]
+        return stats
+
+    def record(self, mcs):
+        """
+        Store the current statistics of all cells in the time series.
+
+        Args:
+            mcs: Monte Carlo step of the current frame
+
+        """
+        stats = self.statistics()
+        stats['mcs'] = np.full(len(stats['id']), mcs, dtype=np.int64)
+        self._records.append(stats)
+
+    def table(self):
+        """
+        Time series of all recorded statistics.
+
+        Returns: dictionary with arrays mcs, id, volume, perimeter, centroid and, when tau is given, type,
+            with one entry per cell per recorded frame
+
+        """
+        if len(self._records) == 0:
+            return {}
+        return {key: np.concatenate([r[key] for r in self._records]) for key in self._records[0]}
+
+
+def analyze_trajectory(frames, neighbourhood='moore'):
+    """
+    Compute the per cell time series of a simulation with an IncrementalAnalyzer.
+
+    Args:
+        frames: sequence of (sigma, tau, mcs) tuples, such as a SnapshotStore; for a DeltaTrajectory the
+            stored changed pixels are used directly
+        neighbourhood: neighbourhood used for the contacts, 'moore' or 'von_neumann'
+
+    Returns: the IncrementalAnalyzer, which holds the time series (see IncrementalAnalyzer.table) and the contacts
+        of the last frame
+
+    """
+    if hasattr(frames, 'changes'):
+        sigma, tau, mcs = frames[0]
+        analyzer = IncrementalAnalyzer(sigma, tau, neighbourhood)
+        analyzer.record(mcs)
+        mcs = frames.mcs
+        for i in range(1, len(frames)):
+            analyzer.apply_changes(*frames.changes(i))
+            analyzer.record(mcs[i])
+        return analyzer
+    analyzer = None
+    for sigma, tau, mcs in frames:
+        if analyzer is None:
+            analyzer = IncrementalAnalyzer(sigma, tau, neighbourhood)
+        else:
+            analyzer.update(sigma, tau)
+        analyzer.record(mcs)
+    return analyzer
+
+
+def _half_offsets(ndim, neighbourhood):
+    """ Neighbour offsets of the given neighbourhood, keeping only one offset of each pair o, -o """
+    if neighbourhood == 'moore':
+        offsets = _moore_offsets(ndim)[:, :ndim]
+    elif neighbourhood == 'von_neumann':
+        offsets = np.eye(ndim, dtype=np.int64)
+    else:
+        raise ValueError('unknown neighbourhood {}, use moore or von_neumann'.format(neighbourhood))
+    return [tuple(o) for o in offsets if o[np.flatnonzero(o)[0]] > 0]
+
+
+def _contact_counts(sigma, labels, offsets):
+    """ Number of neighbouring pixel pairs per pair of labels (lowest label first) """
+    rows = []
+    cols = []
+    for o in offsets:
+        src = tuple(slice(max(0, -k), n - max(0, k)) for k, n in zip(o, sigma.shape))
+        dst = tuple(slice(max(0, k), n - max(0, -k)) for k, n in zip(o, sigma.shape))
+        contact = sigma[src] != sigma[dst]
+        rows.append(labels[src][contact])
+        cols.append(labels[dst][contact])
+    rows = np.concatenate(rows).astype(np.int64)
+    cols = np.concatenate(cols).astype(np.int64)
+    n = max(int(labels.max()) + 1 if labels.size > 0 else 1, 1)
+    # aggregate the pixel pairs per label pair, which gives a much shorter list
+    keys, counts = np.unique(np.minimum(rows, cols) * n + np.maximum(rows, cols), return_counts=True)
+    return keys // n, keys % n, counts
+
+
+@jit(nopython=True, cache=True)
+def _cell_sums(sigma, tau, n, ndim):
+    w, h, d = sigma.shape
+    volume = np.zeros(n, dtype=np.int64)
+    perimeter = np.zeros(n, dtype=np.int64)
+    sums = np.zeros((n, 3), dtype=np.int64)
+    moments = np.zeros((n, 6), dtype=np.int64)
+    bbox = np.empty((n, 6), dtype=np.int64)
+    bbox[:, :3] = np.iinfo(np.int64).max
+    bbox[:, 3:] = -1
+    types = np.zeros(n, dtype=tau.dtype)
+    has_tau = tau.shape == sigma.shape
+    for x in range(w):
+        for y in range(h):
+            for z in range(d):
+                s = sigma[x, y, z]
+                if s <= 0:
+                    continue
+                volume[s] += 1
+                if has_tau:
+                    types[s] = tau[x, y, z]
+                sums[s, 0] += x
+                sums[s, 1] += y
+                sums[s, 2] += z
+                moments[s, 0] += x * x
+                moments[s, 1] += x * y
+                moments[s, 2] += x * z
+                moments[s, 3] += y * y
+                moments[s, 4] += y * z
+                moments[s, 5] += z * z
+                bbox[s, 0] = min(bbox[s, 0], x)
+                bbox[s, 1] = min(bbox[s, 1], y)
+                bbox[s, 2] = min(bbox[s, 2], z)
+                bbox[s, 3] = max(bbox[s, 3], x)
+                bbox[s, 4] = max(bbox[s, 4], y)
+                bbox[s, 5] = max(bbox[s, 5], z)
+                faces = 0
+                faces += x == 0 or sigma[x - 1, y, z] != s
+                faces += x == w - 1 or sigma[x + 1, y, z] != s
+                faces += y == 0 or sigma[x, y - 1, z] != s
+                faces += y == h - 1 or sigma[x, y + 1, z] != s
+                if ndim == 3:
+                    faces += z == 0 or sigma[x, y, z - 1] != s
+                    faces += z == d - 1 or sigma[x, y, z + 1] != s
+                perimeter[s] += faces
+    return volume, perimeter, sums, moments, bbox, types
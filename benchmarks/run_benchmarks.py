@@ -0,0 +1,228 @@
+""" Benchmarks for the initialization and rendering hot paths of cpm_tools
+
+Every benchmark is run for a sweep of grid sizes, and the seeding and growth benchmarks also for a sweep of cell
+counts. The first call of each benchmark is timed separately, because it includes the numba compilation of the
+kernels (for the first case of the sweep), after which the steady-state time is the median over a number of
+repeats. The peak memory is measured with tracemalloc on an
+extra run; it covers numpy arrays and Python objects, but not memory allocated inside numba kernels.
+
+The import benchmarks run in a fresh interpreter; the statement 'pass' gives the interpreter start-up time as a
+baseline. Run cpm_tools.warmup() first to time imports with all numba kernels cached.
+
+Usage:
+    python run_benchmarks.py -o results.json            # run all benchmarks
+    python run_benchmarks.py -o results.json --quick    # smaller sweep
+    python run_benchmarks.py -k draw -o draw.json       # only benchmarks with 'draw' in their name
+    python run_benchmarks.py --compare old.json new.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import numba
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import animation
+
+from cpm_tools import (seed_cells, seed_cells_3d, grow_cells_DLA, grow_cells_round, get_2d_projection,
+                       draw_cpm_grid, animate_cpm_sim_mpl)
+
+COLORMAP = {0: (255, 255, 255), 1: (255, 0, 0), 2: (0, 0, 255)}
+COLORS = ['white', 'red', 'blue']
+
+
+def cell_grid(w, r=5, seed=0):
+    """ Grid with round cells of radius r, about one cell per (2.5 r)^2 pixels """
+    n = int((w / (2.5 * r)) ** 2)
+    return grow_cells_round(seed_cells(w, w, n, pad=r, dist=2 * r, rng=seed), r)
+
+
+def cell_grid_3d(w, r=4, seed=0):
+    n = int((w / (2.5 * r)) ** 3)
+    return grow_cells_round(seed_cells_3d(w, w, w, n, pad=r, dist=2 * r, rng=seed), r)
+
+
+def bench_seed_cells_naive(w, n):
+    return {'w': w, 'n': n}, lambda p: seed_cells(w, w, n, pad=2, rng=0)
+
+
+def bench_seed_cells_poisson(w, n):
+    return {'w': w, 'n': n, 'dist': 8}, lambda p: seed_cells(w, w, n, pad=2, dist=p['dist'], rng=0)
+
+
+def bench_grow_cells_DLA(w, n):
+    seeds = seed_cells(w, w, n, pad=2, dist=10, rng=0)
+    return {'w': w, 'n': n, 'volume': 300}, lambda p: grow_cells_DLA(seeds, p['volume'], rng=0)
+
+
+def bench_grow_cells_round(w, n):
+    seeds = seed_cells(w, w, n, pad=5, dist=10, rng=0)
+    # grow_cells_round draws into its argument, so every run gets a fresh copy of the seeds
+    return {'w': w, 'n': n, 'r': 5}, lambda p: grow_cells_round(seeds.copy(), p['r'])
+
+
+def bench_grow_cells_DLA_threads(w, method, threads):
+    """ DLA growth with a given number of numba threads, which shows how a method scales with the core count """
+    n = w * w // 400
+    seeds = seed_cells(w, w, n, pad=2, dist=10, rng=0)
+
+    def run(p):
+        numba.set_num_threads(threads)
+        try:
+            grow_cells_DLA(seeds, p['volume'], rng=0, method=method)
+        finally:
+            numba.set_num_threads(numba.config.NUMBA_NUM_THREADS)
+    return {'w': w, 'n': n, 'volume': 300, 'method': method, 'threads': threads}, run
+
+
+def thread_counts():
+    """ Powers of two up to the number of numba threads, and the number of threads itself """
+    n = numba.config.NUMBA_NUM_THREADS
+    return [2 ** i for i in range(n.bit_length()) if 2 ** i < n] + [n]
+
+
+def cell_sweep(sizes, counts, area):
+    """ All combinations of grid width and cell count in which cells of the given area cover at most half of the
+    grid """
+    return [(w, n) for w in sizes for n in counts if n * area <= w * w // 2]
+
+
+def bench_get_2d_projection(w):
+    sigma = cell_grid_3d(w // 4)
+    tau = sigma % 3
+
+    def run(p):
+        for projection in ('+x', '-x', '+y', '-y', '+z', '-z'):
+            get_2d_projection(sigma, tau, projection)
+    return {'w': w // 4, 'projections': 6}, run
+
+
+def bench_draw_cpm_grid(w, scale):
+    sigma = cell_grid(w)
+    tau = sigma % 3
+    return {'w': w, 'scale': scale}, lambda p: draw_cpm_grid(sigma, tau, COLORMAP, scale=scale)
+
+
+def bench_animate_cpm_sim_mpl(w, frames=10):
+    taus = [cell_grid(w, seed=i) % 3 for i in range(frames)]
+    # encoding needs ffmpeg, without it only the construction of the animation is timed
+    fn = '/tmp/cpm_tools_benchmark.mp4' if animation.writers.is_available('ffmpeg') else None
+
+    def run(p):
+        anim = animate_cpm_sim_mpl(taus, COLORS, fn)
+        matplotlib.pyplot.close(anim._fig)
+    return {'w': w, 'frames': frames, 'encode': fn is not None}, run
+
+
+def bench_import(statement):
+    """ Time a statement in a fresh interpreter, including interpreter start-up and (cached) kernel loading """
+    return {'statement': statement}, lambda p: subprocess.check_call([sys.executable, '-c', statement])
+
+
+def benchmarks(quick):
+    sizes = [128, 256] if quick else [256, 512, 1024, 2048]
+    counts = [10, 100, 1000] if quick else [100, 1000, 10000, 100000]
+    cases = [('import', bench_import, [('pass',), ('import cpm_tools',),
+                                       ('import cpm_tools; cpm_tools.seed_cells(100, 100, 20, dist=5)',),
+                                       ('import cpm_tools; cpm_tools.draw_cpm_grid',)]),
+             ('seed_cells_naive', bench_seed_cells_naive, cell_sweep(sizes, counts, 1)),
+             ('seed_cells_poisson', bench_seed_cells_poisson, cell_sweep(sizes, counts, 100)),
+             ('grow_cells_DLA', bench_grow_cells_DLA, cell_sweep(sizes, counts, 300)),
+             ('grow_cells_round', bench_grow_cells_round, cell_sweep(sizes, counts, 100)),
+             ('get_2d_projection', bench_get_2d_projection, [(w,) for w in sizes])]
+    for method in ('frontier', 'checkerboard'):
+        cases.append(('grow_cells_DLA_{}_threads'.format(method), bench_grow_cells_DLA_threads,
+                      [(sizes[-1], method, threads) for threads in thread_counts()]))
+    for scale in (1, 2, 5):
+        cases.append(('draw_cpm_grid_scale{}'.format(scale), bench_draw_cpm_grid, [(w, scale) for w in sizes]))
+    cases.append(('animate_cpm_sim_mpl', bench_animate_cpm_sim_mpl, [(w,) for w in sizes[:2]]))
+    return cases
+
+
+def measure(run, params, repeat):
+    """ Time the first call, repeated calls and the peak memory of run(params) """
+    start = time.perf_counter()
+    run(params)
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(params)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run(params)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first, times, peak
+
+
+def run_benchmarks(quick=False, repeat=5, keyword=None):
+    results = []
+    for name, setup, sweep in benchmarks(quick):
+        if keyword is not None and keyword not in name:
+            continue
+        for i, args in enumerate(sweep):
+            params, run = setup(*args)
+            first, times, peak = measure(run, params, repeat)
+            median = float(np.median(times))
+            result = {'name': name, 'params': params, 'first_s': first, 'times_s': times,
+                      'min_s': min(times), 'median_s': median, 'peak_memory_bytes': peak}
+            # the first call for the smallest size includes the compilation of the numba kernels
+            if i == 0:
+                result['compile_s'] = max(first - median, 0.)
+            results.append(result)
+            print('{:<24} {:<50} median {:9.4f} s  compile {:7.3f} s  peak {:8.1f} MB'.format(
+                name, json.dumps(params), median, result.get('compile_s', 0.), peak / 1e6))
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'numba': numba.__version__, 'machine': platform.machine(),
+            'processor': platform.processor()}
+
+
+def compare(old_fn, new_fn):
+    """ Print the ratio of the median times of two result files """
+    with open(old_fn) as f:
+        old = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+    with open(new_fn) as f:
+        new = json.load(f)['results']
+    for r in new:
+        key = (r['name'], json.dumps(r['params'], sort_keys=True))
+        if key in old:
+            ratio = r['median_s'] / old[key]['median_s']
+            print('{:<24} {:<50} {:9.4f} s -> {:9.4f} s  x{:.2f}'.format(key[0], key[1], old[key]['median_s'],
+                                                                    r['median_s'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cpm_tools')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='output file (json)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed repeats')
+    parser.add_argument('-k', '--keyword', help='only run benchmarks with this keyword in their name')
+    parser.add_argument('--quick', action='store_true', help='run a smaller sweep')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    # the seeding functions warn when fewer cells fit than requested, which is expected for the denser sweeps
+    warnings.simplefilter('ignore', UserWarning)
+    results = run_benchmarks(args.quick, args.repeat, args.keyword)
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': metadata(), 'argv': sys.argv[1:], 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
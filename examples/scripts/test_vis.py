@@ -1,3 +1,4 @@
+import numpy as np
 from cpm_tools import *
 
 w = 100
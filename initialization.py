@@ -1,87 +1,603 @@
-import copy
+import itertools
+import multiprocessing
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from numba import jit
-import imageio
+from numba import get_num_threads, jit, prange
 
 
-def grow_cells_DLA(grid, volume):
+def grow_cells_DLA(grid, volume, maxit=None, rng=None, method='frontier'):
     """
     Grow cells using diffusion limited aggregation (DLA). Growth continues until
-    all cells have the desired volume and cells cannot grow beyond that volume.
+    all cells have the desired volume or none of the cells can grow any further.
+    Works on 2D grids (8-neighbourhood) as well as on 3D grids (26-neighbourhood).
+
+    With the 'frontier' method only the frontier, i.e. the empty pixels next to a cell that has
+    not yet reached its target volume, is visited in each step, in random order. To keep the
+    memory access local, the frontier is shuffled in chunks of pixels that lie close together,
+    and the chunks are visited in random order. Every frontier pixel picks a random neighbour
+    and joins that neighbour's cell when the cell is still growing.
+
+    With the 'checkerboard' method the lattice is split by coordinate parity into 4 (2D)
+    or 8 (3D) sublattices, in which no two pixels are neighbours. In each step the sublattices
+    are visited in random order, and all empty pixels of a sublattice pick a random neighbour
+    at the same time, in parallel. When more pixels want to join a cell than it can take,
+    a random subset is accepted. Random numbers are derived from a hash of the pixel index,
+    so the result does not depend on the number of threads.
 
     Args:
-        w: CPM grid
-        volume: cell volume
+        grid: CPM grid with seeded cells
+        volume: cell volume, either a single value or one value per cell
+        maxit: maximum number of growth steps (no limit when None)
+        rng: numpy random generator or seed
+        method: 'frontier' or 'checkerboard'
 
-    Returns: CPM grid
+    Returns: CPM grid with the same dtype as the input grid
 
     """
-    n = np.max(grid)
-    w = grid.shape[0]
-    h = grid.shape[1]
-    nx = [-1, -1, 0, 1, 1, 1, 0, -1]
-    ny = [0, 1, 1, 1, 0, -1, -1, -1]
-    pix = [[x, y] for x in range(w) for y in range(h)]
-    # while np.any(np.bincount(grid.flatten())[1:] < volume):
-    while np.sum(grid > 0) < volume * n:
-        grid = _DLA_step(copy.deepcopy(grid),volume,w,h)
-    return grid
+    rng = np.random.default_rng(rng)
+    sigma = np.array(grid, order='C')
+    sigma3d = sigma.reshape(_as_3d(sigma.shape))
+    nbs = _moore_offsets(grid.ndim)
+    n = int(sigma.max())
+    volumes = np.bincount(sigma.ravel(), minlength=n + 1)
+    target = np.zeros(n + 1, dtype=np.int64)
+    target[1:] = volume
+    if method == 'checkerboard':
+        _grow_cells_DLA_checkerboard(sigma3d, volumes, target, nbs, grid.ndim, maxit, rng)
+        return sigma
+    elif method != 'frontier':
+        raise ValueError('unknown method {}, use frontier or checkerboard'.format(method))
+    in_frontier = np.zeros(sigma3d.shape, dtype=np.bool_)
+    frontier = _DLA_frontier(sigma3d, volumes, target, nbs, in_frontier)
+    it = 0
+    while len(frontier) > 0 and (maxit is None or it < maxit):
+        chunks = rng.permutation(-(-len(frontier) // _DLA_CHUNK))
+        u = rng.random(len(frontier))
+        r = rng.integers(0, len(nbs), len(frontier), dtype=np.uint8)
+        frontier = _DLA_step(sigma3d, volumes, target, nbs, frontier, chunks, u, r, in_frontier)
+        it += 1
+    return sigma
+
 
+def _as_3d(shape):
+    return tuple(shape) + (1,) * (3 - len(shape))
 
-@jit(nopython=True)
-def _DLA_step(grid,volume,w,h):
-    nx = [-1, -1, 0, 1, 1, 1, 0, -1]
-    ny = [0, 1, 1, 1, 0, -1, -1, -1]
-    pix = [[x, y] for x in range(w) for y in range(h)]
-    r = np.random.randint(0, 7, w * h)
-    for i, (x, y) in enumerate(pix):
-        if grid[x, y] > 0:
+
+def _moore_offsets(ndim):
+    offsets = [o + (0,) * (3 - ndim) for o in itertools.product((-1, 0, 1), repeat=ndim) if any(o)]
+    return np.array(offsets, dtype=np.int64)
+
+
+@jit(nopython=True, cache=True)
+def _growing_neighbour(grid, volumes, target, nbs, x, y, z):
+    w, h, d = grid.shape
+    for k in range(nbs.shape[0]):
+        nb_x = x + nbs[k, 0]
+        nb_y = y + nbs[k, 1]
+        nb_z = z + nbs[k, 2]
+        if (nb_x < 0) or (nb_y < 0) or (nb_z < 0) or (nb_x >= w) or (nb_y >= h) or (nb_z >= d):
             continue
-        nb_x = x + nx[r[i]]
-        nb_y = y + ny[r[i]]
-        if (nb_x < 0) or (nb_y < 0) or (nb_x >= w) or (nb_y >= h):
+        c = grid[nb_x, nb_y, nb_z]
+        if c > 0 and volumes[c] < target[c]:
+            return True
+    return False
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _DLA_frontier(grid, volumes, target, nbs, in_frontier):
+    # mark the empty neighbours of all pixels of growing cells, then collect the marked pixels
+    w, h, d = grid.shape
+    for x in prange(w):
+        for y in range(h):
+            for z in range(d):
+                c = grid[x, y, z]
+                if c == 0 or volumes[c] >= target[c]:
+                    continue
+                for k in range(nbs.shape[0]):
+                    nb_x = x + nbs[k, 0]
+                    nb_y = y + nbs[k, 1]
+                    nb_z = z + nbs[k, 2]
+                    if (nb_x < 0) or (nb_y < 0) or (nb_z < 0) or (nb_x >= w) or (nb_y >= h) or (nb_z >= d):
+                        continue
+                    if grid[nb_x, nb_y, nb_z] == 0:
+                        in_frontier[nb_x, nb_y, nb_z] = True
+    return _collect_frontier(grid, volumes, target, nbs, in_frontier, True)
+
+
+@jit(nopython=True, cache=True)
+def _interior(x, y, z, w, h, d):
+    # True when all neighbours of the pixel lie on the grid (in 2D, d == 1 and the neighbours have z == 0)
+    return 0 < x < w - 1 and 0 < y < h - 1 and (d == 1 or 0 < z < d - 1)
+
+
+@jit(nopython=True, cache=True)
+def _unravel(i, h, d):
+    # coordinates of the flat index i; floating-point division is much faster than integer division and exact for
+    # indices below 2 ** 53
+    x = np.int64(i / (h * d))
+    rest = i - x * h * d
+    y = np.int64(rest / d)
+    return x, y, rest - y * d
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _collect_frontier(grid, volumes, target, nbs, in_frontier, check=True):
+    # Unmark the marked pixels that are filled or, when check is set, no longer touch a growing cell, and return
+    # the others in raster order. The marks are scanned in parallel blocks, 8 at a time as 64-bit words, such that
+    # empty parts of the grid are skipped quickly.
+    w, h, d = grid.shape
+    flat = grid.reshape(-1)
+    marks = in_frontier.reshape(-1)
+    words = marks[:len(marks) // 8 * 8].view(np.uint64)
+    steps = (nbs[:, 0] * h + nbs[:, 1]) * d + nbs[:, 2]
+    nblocks = min(1024, (len(marks) + 7) // 8)
+    size = ((len(marks) + nblocks - 1) // nblocks + 7) // 8 * 8
+    counts = np.zeros(nblocks + 1, dtype=np.int64)
+    for b in prange(nblocks):
+        m = 0
+        for j in range(b * size, min((b + 1) * size, len(marks)), 8):
+            if j // 8 < len(words) and words[j // 8] == 0:
+                continue
+            for i in range(j, min(j + 8, len(marks))):
+                if not marks[i]:
+                    continue
+                keep = flat[i] == 0
+                if keep and check:
+                    keep = False
+                    x, y, z = _unravel(i, h, d)
+                    if _interior(x, y, z, w, h, d):
+                        for k in range(len(steps)):
+                            c = flat[i + steps[k]]
+                            if c > 0 and volumes[c] < target[c]:
+                                keep = True
+                                break
+                    else:
+                        keep = _growing_neighbour(grid, volumes, target, nbs, x, y, z)
+                if keep:
+                    m += 1
+                else:
+                    marks[i] = False
+        counts[b + 1] = m
+    offsets = np.cumsum(counts)
+    frontier = np.empty(offsets[-1], dtype=np.int64)
+    for b in prange(nblocks):
+        m = offsets[b]
+        for j in range(b * size, min((b + 1) * size, len(marks)), 8):
+            if j // 8 < len(words) and words[j // 8] == 0:
+                continue
+            for i in range(j, min(j + 8, len(marks))):
+                if marks[i]:
+                    frontier[m] = i
+                    m += 1
+    return frontier
+
+
+# number of consecutive frontier pixels that are shuffled together in a DLA step
+_DLA_CHUNK = 4096
+
+
+@jit(nopython=True, cache=True)
+def _DLA_step(grid, volumes, target, nbs, frontier, chunks, u, r, in_frontier):
+    # The frontier is visited in random order chunk by chunk: the chunks in the order given by chunks, and the
+    # pixels of each chunk in an order shuffled with the uniform random numbers u. As the frontier is in raster
+    # order, each chunk covers a small part of the grid, which keeps the memory access local.
+    w, h, d = grid.shape
+    flat = grid.reshape(-1)
+    marks = in_frontier.reshape(-1)
+    steps = (nbs[:, 0] * h + nbs[:, 1]) * d + nbs[:, 2]
+    order = np.empty(_DLA_CHUNK, dtype=np.int64)
+    # pixels only drop out of the frontier by being filled, unless a cell reaches its target volume
+    full = False
+    for chunk in chunks:
+        start = chunk * _DLA_CHUNK
+        m = min(_DLA_CHUNK, len(frontier) - start)
+        for j in range(m):
+            order[j] = start + j
+        for j in range(m - 1, 0, -1):
+            k = int(u[start + j] * (j + 1))
+            order[j], order[k] = order[k], order[j]
+        for j in range(m):
+            i = frontier[order[j]]
+            x = i // (h * d)
+            y = (i - x * h * d) // d
+            z = i - (x * h + y) * d
+            # pixels away from the border can use flat offsets without bounds checks
+            interior = _interior(x, y, z, w, h, d)
+            k = r[order[j]]
+            if interior:
+                c = flat[i + steps[k]]
+            else:
+                nb_x = x + nbs[k, 0]
+                nb_y = y + nbs[k, 1]
+                nb_z = z + nbs[k, 2]
+                if (nb_x < 0) or (nb_y < 0) or (nb_z < 0) or (nb_x >= w) or (nb_y >= h) or (nb_z >= d):
+                    continue
+                c = grid[nb_x, nb_y, nb_z]
+            if c == 0 or volumes[c] >= target[c]:
+                continue
+            flat[i] = c
+            volumes[c] += 1
+            full |= volumes[c] == target[c]
+            # empty neighbours of the new pixel become part of the frontier
+            if interior:
+                for k in range(nbs.shape[0]):
+                    marks[i + steps[k]] |= flat[i + steps[k]] == 0
+                continue
+            for k in range(nbs.shape[0]):
+                nb_x = x + nbs[k, 0]
+                nb_y = y + nbs[k, 1]
+                nb_z = z + nbs[k, 2]
+                if (nb_x < 0) or (nb_y < 0) or (nb_z < 0) or (nb_x >= w) or (nb_y >= h) or (nb_z >= d):
+                    continue
+                if grid[nb_x, nb_y, nb_z] == 0:
+                    in_frontier[nb_x, nb_y, nb_z] = True
+    return _collect_frontier(grid, volumes, target, nbs, in_frontier, full)
+
+
+def _grow_cells_DLA_checkerboard(sigma, volumes, target, nbs, ndim, maxit, rng):
+    w, h, d = sigma.shape
+    in_frontier = np.zeros(sigma.shape, dtype=np.bool_)
+    frontier = _DLA_frontier(sigma, volumes, target, nbs, in_frontier)
+    # proposal counts per thread and per cell, zero between updates
+    counts = np.zeros((get_num_threads(), len(volumes)), dtype=np.int64)
+    # in 2D the z coordinate is always 0, which leaves the even sublattices
+    sublattices = np.arange(8) if ndim == 3 else np.arange(0, 8, 2)
+    it = 0
+    while len(frontier) > 0 and (maxit is None or it < maxit):
+        frontier, offsets = _split_sublattices(frontier, h, d)
+        full = False
+        for k in sublattices[rng.permutation(len(sublattices))]:
+            seed = np.uint64(rng.integers(2 ** 63))
+            full |= _checkerboard_update(sigma, volumes, target, nbs, frontier[offsets[k]:offsets[k + 1]], seed,
+                                         counts, in_frontier)
+        frontier = _collect_frontier(sigma, volumes, target, nbs, in_frontier, full)
+        it += 1
+
+
+# number of chunks in which the frontier and the proposals are split for parallel processing
+_CHECKERBOARD_CHUNKS = 256
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _split_sublattices(frontier, h, d):
+    # order the pixels by sublattice, i.e. by the parity of their coordinates, with a counting sort that counts
+    # and places the pixels of each chunk of the frontier in parallel
+    n = len(frontier)
+    size = (n + _CHECKERBOARD_CHUNKS - 1) // _CHECKERBOARD_CHUNKS
+    counts = np.zeros((8, _CHECKERBOARD_CHUNKS), dtype=np.int64)
+    for c in prange(_CHECKERBOARD_CHUNKS):
+        for j in range(c * size, min((c + 1) * size, n)):
+            x, y, z = _unravel(frontier[j], h, d)
+            counts[(x % 2) * 4 + (y % 2) * 2 + z % 2, c] += 1
+    starts = np.zeros(8 * _CHECKERBOARD_CHUNKS + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(counts)
+    ordered = np.empty_like(frontier)
+    for c in prange(_CHECKERBOARD_CHUNKS):
+        position = np.empty(8, dtype=np.int64)
+        for k in range(8):
+            position[k] = starts[k * _CHECKERBOARD_CHUNKS + c]
+        for j in range(c * size, min((c + 1) * size, n)):
+            x, y, z = _unravel(frontier[j], h, d)
+            k = (x % 2) * 4 + (y % 2) * 2 + z % 2
+            ordered[position[k]] = frontier[j]
+            position[k] += 1
+    return ordered, starts[::_CHECKERBOARD_CHUNKS].copy()
+
+
+@jit(nopython=True, cache=True)
+def _splitmix64(x):
+    # counter-based random number: a hash of x
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@jit(nopython=True, cache=True)
+def _propose(grid, volumes, target, nbs, x, y, z, seed):
+    # cell that the empty pixel x, y, z wants to join (0 for none) and a random key to rank the proposal
+    w, h, d = grid.shape
+    if grid[x, y, z] != 0:
+        return 0, np.uint64(0)
+    r = _splitmix64(seed + np.uint64((x * h + y) * d + z))
+    k = np.int64(r % np.uint64(nbs.shape[0]))
+    nb_x = x + nbs[k, 0]
+    nb_y = y + nbs[k, 1]
+    nb_z = z + nbs[k, 2]
+    if (nb_x < 0) or (nb_y < 0) or (nb_z < 0) or (nb_x >= w) or (nb_y >= h) or (nb_z >= d):
+        return 0, r
+    c = np.int64(grid[nb_x, nb_y, nb_z])
+    if c == 0 or volumes[c] >= target[c]:
+        return 0, r
+    return c, _splitmix64(r)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _checkerboard_update(grid, volumes, target, nbs, candidates, seed, counts, in_frontier):
+    # Let the empty pixels of one sublattice join a growing neighbour at the same time. Every step runs in
+    # parallel: proposals are counted per thread and per cell, and a cell with more proposals than it can take
+    # accepts those with the smallest keys. Returns whether a cell reached its target volume.
+    w, h, d = grid.shape
+    flat = grid.reshape(-1)
+    marks = in_frontier.reshape(-1)
+    steps = (nbs[:, 0] * h + nbs[:, 1]) * d + nbs[:, 2]
+    n = len(candidates)
+    nchunks = counts.shape[0]
+    size = (n + nchunks - 1) // nchunks
+    # the cell that each candidate proposes to join (0 for none)
+    cells = np.empty(n, dtype=np.int64)
+    keys = np.empty(n, dtype=np.uint64)
+    for t in prange(nchunks):
+        for j in range(t * size, min((t + 1) * size, n)):
+            x, y, z = _unravel(candidates[j], h, d)
+            cells[j], keys[j] = _propose(grid, volumes, target, nbs, x, y, z, seed)
+            if cells[j] > 0:
+                counts[t, cells[j]] += 1
+    # per cell, the total number of proposals, and per chunk the number of proposals in the preceding chunks
+    ncells = len(volumes)
+    total = np.zeros(ncells, dtype=np.int64)
+    for c in prange(ncells):
+        m = 0
+        for t in range(nchunks):
+            if counts[t, c] > 0:
+                m_t = counts[t, c]
+                counts[t, c] = m
+                m += m_t
+        total[c] = m
+    space = target - volumes
+    over = total > space
+    starts = np.zeros(ncells + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.where(over, total, 0))
+    # proposals to cells that can take all of them are accepted, the others are grouped by cell
+    accepted = np.zeros(n, dtype=np.bool_)
+    grouped = np.empty(starts[-1], dtype=np.int64)
+    for t in prange(nchunks):
+        for j in range(t * size, min((t + 1) * size, n)):
+            c = cells[j]
+            if c == 0:
+                continue
+            if over[c]:
+                grouped[starts[c] + counts[t, c]] = j
+                counts[t, c] += 1
+            else:
+                accepted[j] = True
+    for c in prange(ncells):
+        if not over[c]:
             continue
-        if grid[nb_x, nb_y] > 0 and np.sum(grid == grid[nb_x, nb_y]) < volume:
-            grid[x, y] = grid[nb_x, nb_y]
-    return grid
+        group = grouped[starts[c]:starts[c + 1]]
+        order = np.argsort(keys[group])
+        for j in range(space[c]):
+            accepted[group[order[j]]] = True
+    nfull = 0
+    for c in prange(ncells):
+        if total[c] > 0:
+            volumes[c] += min(total[c], space[c])
+            if volumes[c] >= target[c]:
+                nfull += 1
+    # counts are only non-zero for the cells that got proposals
+    for t in prange(nchunks):
+        for j in range(t * size, min((t + 1) * size, n)):
+            if cells[j] > 0:
+                counts[t, cells[j]] = 0
+    # Empty neighbours of the new pixels join the frontier. Neighbouring new pixels can mark the same pixel from
+    # different threads, but only ever store True, so the marks do not depend on the order of the threads.
+    for j in prange(n):
+        if not accepted[j]:
+            continue
+        i = candidates[j]
+        flat[i] = cells[j]
+        x, y, z = _unravel(i, h, d)
+        if _interior(x, y, z, w, h, d):
+            for k in range(len(steps)):
+                if flat[i + steps[k]] == 0:
+                    marks[i + steps[k]] = True
+            continue
+        for k in range(nbs.shape[0]):
+            nb_x = x + nbs[k, 0]
+            nb_y = y + nbs[k, 1]
+            nb_z = z + nbs[k, 2]
+            if (nb_x < 0) or (nb_y < 0) or (nb_z < 0) or (nb_x >= w) or (nb_y >= h) or (nb_z >= d):
+                continue
+            if grid[nb_x, nb_y, nb_z] == 0:
+                in_frontier[nb_x, nb_y, nb_z] = True
+    return nfull > 0
+
+
+def grow_cells_confluent(grid, volume=None):
+    """
+    Fill the grid with cells in a single pass, by giving every empty pixel to the cell of the nearest
+    non-empty pixel (a Voronoi tessellation of the seeds), found with a Euclidean distance transform.
+    When a volume is given, cells that are too large are trimmed by removing their pixels that are farthest
+    from the cell's seed, which leaves those pixels empty. Works on 2D as well as on 3D grids.
+
+    Args:
+        grid: CPM grid with seeded cells
+        volume: maximum cell volume, either a single value or one value per cell (no maximum when None)
 
+    Returns: CPM grid with the same dtype as the input grid
 
-def grow_cells_round(grid, r):
     """
-    Grow seeded cells into circles
+    # imported here, such that seeding and growing cells does not require scipy
+    from scipy import ndimage
+    grid = np.ascontiguousarray(grid)
+    if not np.any(grid):
+        return grid.copy()
+    # the feature transform holds the coordinates of the nearest non-empty pixel, one int32 row per axis; labels
+    # are gathered from it directly, without converting the coordinates to (int64) index arrays
+    index = np.empty((grid.ndim,) + grid.shape, dtype=np.int32)
+    ndimage.distance_transform_edt(grid == 0, return_distances=False, return_indices=True, indices=index)
+    index = index.reshape(grid.ndim, -1)
+    strides = np.array(grid.strides, dtype=np.int64) // grid.itemsize
+    sigma = np.empty_like(grid)
+    flat = sigma.reshape(-1)
+    _nearest_labels(grid.reshape(-1), index, strides, flat)
+    if volume is None:
+        return sigma
+    n = int(flat.max())
+    target = np.zeros(n + 1, dtype=np.int64)
+    target[1:] = volume
+    # only the pixels of cells that are too large need to be ranked by their distance to the seed
+    counts = _label_counts(flat, n + 1)
+    too_large = counts > target
+    too_large[0] = False
+    if not np.any(too_large):
+        return sigma
+    offsets = np.zeros(n + 2, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.where(too_large, counts, 0))
+    pixels = np.empty(offsets[-1], dtype=np.uint32 if flat.size < 2 ** 32 else np.int64)
+    _group_pixels(flat, too_large, offsets, pixels)
+    _trim_cells(flat, index, strides, pixels, offsets, target)
+    return sigma
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _nearest_labels(grid, index, strides, sigma):
+    for i in prange(len(sigma)):
+        j = 0
+        for axis in range(len(strides)):
+            j += index[axis, i] * strides[axis]
+        sigma[i] = grid[j]
+
+
+@jit(nopython=True, cache=True)
+def _label_counts(sigma, n):
+    counts = np.zeros(n, dtype=np.int64)
+    for i in range(len(sigma)):
+        counts[sigma[i]] += 1
+    return counts
+
+
+@jit(nopython=True, cache=True)
+def _group_pixels(sigma, selected, offsets, pixels):
+    # counting sort of the pixels of the selected cells by cell
+    position = offsets[:-1].copy()
+    for i in range(len(sigma)):
+        c = sigma[i]
+        if selected[c]:
+            pixels[position[c]] = i
+            position[c] += 1
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _trim_cells(sigma, index, strides, pixels, offsets, target):
+    # remove the pixels of each cell that are farthest from its seed, i.e. from their nearest non-empty pixel
+    for c in prange(len(target)):
+        group = pixels[offsets[c]:offsets[c + 1]]
+        if len(group) <= target[c]:
+            continue
+        d2 = np.zeros(len(group), dtype=np.int64)
+        for j in range(len(group)):
+            i = np.int64(group[j])
+            rest = i
+            for axis in range(len(strides)):
+                coord = rest // strides[axis]
+                rest -= coord * strides[axis]
+                d2[j] += (index[axis, i] - coord) ** 2
+        order = np.argsort(d2, kind='mergesort')
+        for j in order[target[c]:]:
+            sigma[group[j]] = 0
+
+
+_OVERLAP = {'last': 0, 'nearest': 1, 'empty': 2}
+
+
+def grow_cells_round(grid, r, overlap='last'):
+    """
+    Grow seeded cells into circles, or into spheres when the grid is 3D. All cells are drawn in a single
+    compiled kernel that processes the grid in parallel along the first axis. Where cells overlap, the
+    overlap policy decides which cell gets the pixel:
+
+    - 'last': the cell with the highest id
+    - 'nearest': the cell with the nearest seed (the lowest id on ties)
+    - 'empty': nobody, pixels covered by more than one cell are left empty
 
     Args:
 
         grid: CPM grid with seeded cells
-        r: cell radius
+        r: cell radius, either a single value or one value per cell
+        overlap: overlap policy ('last', 'nearest' or 'empty')
 
     Returns: Numpy array representing sigma
 
     """
-    pix = np.column_stack(np.where(grid > 0))
-    w = grid.shape[0]
-    h = grid.shape[1]
-    for idx, (x, y) in enumerate(pix, 1):
-        grid = _grow_to_circle(grid,idx,x,y,r,w,h)
+    if overlap not in _OVERLAP:
+        raise ValueError('unknown overlap policy {}, use one of {}'.format(overlap, list(_OVERLAP)))
+    grid = np.ascontiguousarray(grid)
+    seeds = np.nonzero(grid)
+    ids = grid[seeds]
+    r = np.asarray(r, dtype=np.float64)
+    if r.ndim == 0:
+        r2 = np.full(len(ids), r ** 2)
+    else:
+        r2 = r[ids.astype(np.int64) - 1] ** 2
+    xs, ys, zs = seeds + (np.zeros(len(ids), dtype=np.int64),) * (3 - grid.ndim)
+    # sort seeds along x such that every slice can look up the cells that cross it
+    order = np.argsort(xs, kind='stable')
+    _stamp_spheres(grid.reshape(_as_3d(grid.shape)), xs[order], ys[order], zs[order], ids[order], r2[order],
+                   _OVERLAP[overlap])
     return grid
 
 
-@jit(nopython=True)
-def _grow_to_circle(grid,idx,x,y,r,w,h):
-    for i in range(-r, r):
-        for j in range(-r, r):
-            if (x + i > 0) and (y + j > 0) and (x + i < w) and (y + j < h):
-                if (i ** 2 + j ** 2) < r ** 2:
-                    grid[x + i, y + j] = idx
-    return grid
+@jit(nopython=True, cache=True)
+def _chord(m):
+    # largest integer c with c ** 2 < m
+    c = int(np.sqrt(m))
+    if c ** 2 >= m:
+        c -= 1
+    return c
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _stamp_spheres(grid, xs, ys, zs, ids, r2, overlap):
+    w, h, d = grid.shape
+    rmax = int(np.ceil(np.sqrt(r2.max()))) if len(r2) > 0 else 0
+    for x in prange(w):
+        owner = np.zeros((h, d), dtype=grid.dtype)
+        dmin = np.full((h, d), np.inf)
+        count = np.zeros((h, d), dtype=np.int64)
+        lo = np.searchsorted(xs, x - rmax)
+        hi = np.searchsorted(xs, x + rmax + 1)
+        for k in range(lo, hi):
+            dx2 = (x - xs[k]) ** 2
+            if dx2 >= r2[k]:
+                continue
+            hy = _chord(r2[k] - dx2)
+            for y in range(max(ys[k] - hy, 0), min(ys[k] + hy + 1, h)):
+                dxy2 = dx2 + (y - ys[k]) ** 2
+                hz = _chord(r2[k] - dxy2)
+                for z in range(max(zs[k] - hz, 0), min(zs[k] + hz + 1, d)):
+                    d2 = dxy2 + (z - zs[k]) ** 2
+                    count[y, z] += 1
+                    if overlap == 0:
+                        if ids[k] > owner[y, z]:
+                            owner[y, z] = ids[k]
+                    elif d2 < dmin[y, z] or (d2 == dmin[y, z] and ids[k] < owner[y, z]):
+                        owner[y, z] = ids[k]
+                        dmin[y, z] = d2
+        for y in range(h):
+            for z in range(d):
+                if count[y, z] == 0:
+                    continue
+                if overlap == 2 and count[y, z] > 1:
+                    grid[x, y, z] = 0
+                else:
+                    grid[x, y, z] = owner[y, z]
 
 
-def seed_cells(w, h, n, pad=10, dist=0, maxit=1000):
+def seed_cells(w, h, n, pad=10, dist=0, maxit=30, rng=None, dtype=None, packing='random'):
     """
     Randomly place single pixels on the CPM grid. When the minimum distance is zero, cells are placed randomly
-    without considering the position of other cells. When the minimum distance is larger than zero,
-    the algorithm attempts to position the desired number of cells considering the minimum distance. To prevent
-    an infinite run, the algorithm is stopped when the maximum number of iterations is reached.
+    without considering the position of other cells, by drawing n distinct positions at once. When the minimum
+    distance is larger than zero, random positions are accepted when no other seed lies within the minimum
+    distance (dart throwing), as long as n is well below the number of seeds that fit. For denser seeding, the
+    grid is first packed with Poisson-disk sampling, which places seeds until no more seeds fit, and then the
+    desired number of cells is picked at random from those seeds. Random packings fill about 55-60% of the
+    densest (hexagonal) packing; the 'lattice' packing places the seeds on a jittered lattice instead, which
+    reaches about 90% of it. When fewer than n seeds fit, all of them are used and a warning reports how many
+    cells were placed.
 
     Args:
         w: grid width
@@ -89,65 +605,432 @@ def seed_cells(w, h, n, pad=10, dist=0, maxit=1000):
         n: number of cells
         pad: padding between cells and border
         dist: minimum distance between cells
-        maxit: maximum number of iterations per cells
+        maxit: number of candidate positions tried around each seed before it is retired
+        rng: numpy random generator or seed
+        dtype: integer dtype of the grid, which must hold all cell ids (defaults to the smallest of uint16 and
+            uint32 that does)
+        packing: 'random' or 'lattice', which spreads the cells over a near-hexagonal lattice with a spacing of
+            at least dist, jittered randomly as far as the minimum distance allows
 
     Returns: CPM grid
 
     """
+    rng = np.random.default_rng(rng)
+    if packing == 'lattice':
+        return _seed_cells_lattice((w, h), n, pad, dist, rng, dtype)
+    elif packing != 'random':
+        raise ValueError('unknown packing {}, use random or lattice'.format(packing))
     if dist > 0:
-        return _seed_cells_complicated(w, h, n, pad, dist, maxit)
+        return _seed_cells_poisson((w, h), n, pad, dist, maxit, rng, dtype)
     else:
-        return _seed_cells_naive(w, h, n, pad)
+        return _seed_cells_naive((w, h), n, pad, rng, dtype)
+
+
+def seed_cells_3d(w, h, d, n, pad=10, dist=0, maxit=30, rng=None, dtype=None, packing='random'):
+    """
+    Randomly place single voxels on a 3D CPM grid. Seeding works as in seed_cells, with 3D Poisson-disk
+    sampling when the minimum distance is larger than zero. The 'lattice' packing uses a jittered
+    face-centred cubic lattice, the densest sphere packing.
+
+    Args:
+        w: grid width
+        h: grid height
+        d: grid depth
+        n: number of cells
+        pad: padding between cells and border
+        dist: minimum distance between cells
+        maxit: number of candidate positions tried around each seed before it is retired
+        rng: numpy random generator or seed
+        dtype: integer dtype of the grid, which must hold all cell ids (defaults to the smallest of uint16 and
+            uint32 that does)
+        packing: 'random' or 'lattice'
 
+    Returns: CPM grid
 
-def _seed_cells_naive(w, h, n, pad=10):
-    grid = np.zeros((w, h))
-    if w * h < n:
-        pix = [(i, j) for i in range(w) for j in range(h)]
-        for idx, (i, j) in enumerate(pix, 1):
-            grid[i, j] = idx
+    """
+    rng = np.random.default_rng(rng)
+    if packing == 'lattice':
+        return _seed_cells_lattice((w, h, d), n, pad, dist, rng, dtype)
+    elif packing != 'random':
+        raise ValueError('unknown packing {}, use random or lattice'.format(packing))
+    if dist > 0:
+        return _seed_cells_poisson((w, h, d), n, pad, dist, maxit, rng, dtype)
     else:
-        while np.sum(grid > 0) < n:
-            x0 = np.random.randint(pad, w - pad)
-            y0 = np.random.randint(pad, h - pad)
-            if grid[x0, y0] == 0:
-                grid[x0, y0] = np.sum(grid > 0) + 1
+        return _seed_cells_naive((w, h, d), n, pad, rng, dtype)
+
+
+def _grid_dtype(n, dtype=None):
+    """ Dtype for grids with cell ids up to n: the given dtype, or the smallest of uint16 and uint32 """
+    if dtype is None:
+        return np.uint16 if n < 2 ** 16 else np.uint32
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer) or np.iinfo(dtype).max < n:
+        raise ValueError('grid dtype must be an integer type that holds cell ids up to {}, got {}'.format(n, dtype))
+    return dtype
+
+
+def _seed_cells_naive(shape, n, pad, rng, dtype=None):
+    inner = tuple(max(s - 2 * pad, 0) for s in shape)
+    size = int(np.prod(inner))
+    if size < n:
+        warnings.warn('only {} of {} cells fit on the grid with padding {}'.format(size, n, pad))
+        n = size
+    pix = np.unravel_index(rng.choice(size, n, replace=False), inner)
+    grid = np.zeros(shape, dtype=_grid_dtype(n, dtype))
+    grid[tuple(p + pad for p in pix)] = np.arange(1, n + 1)
     return grid
 
 
-def _seed_cells_complicated(w, h, n, pad=10, dist=2, maxit=1000):
-    pix = []
-    it = 0
-    while len(pix) < n:
-        x = np.random.randint(pad, w - pad)
-        y = np.random.randint(pad, h - pad)
+# fraction of space covered by disks (2D) or balls (3D) of diameter dist when random sequential placement jams
+_JAMMING = {2: 0.547, 3: 0.382}
+
+
+def _seed_cells_poisson(shape, n, pad, dist, maxit, rng, dtype=None):
+    inner = [max(s - 2 * pad, 0) for s in shape]
+    ball = np.pi * dist ** 2 / 4 if len(shape) == 2 else np.pi * dist ** 3 / 6
+    pix = None
+    # well below the jamming density most darts hit, so n seeds are found in O(n) time; the full packing below
+    # costs time proportional to the grid size
+    if n <= 0.5 * _JAMMING[len(shape)] * np.prod(inner) / ball:
+        bounds = [(pad, s - pad) for s in shape] + [(0, 1)] * (3 - len(shape))
+        pix = _dart_throwing(*(b for bound in bounds for b in bound), len(shape), float(dist), n, maxit * n,
+                             rng.integers(2 ** 31))[:len(shape)]
+        if len(pix[0]) < n:
+            pix = None
+    if pix is None:
+        if len(shape) == 2:
+            pix = _poisson_disk(pad, shape[0] - pad, pad, shape[1] - pad, float(dist), maxit,
+                                rng.integers(2 ** 31))
+        else:
+            pix = _poisson_disk_3d(pad, shape[0] - pad, pad, shape[1] - pad, pad, shape[2] - pad, float(dist),
+                                   maxit, rng.integers(2 ** 31))
+    if len(pix[0]) > n:
+        keep = rng.choice(len(pix[0]), n, replace=False)
+        pix = tuple(p[keep] for p in pix)
+    elif len(pix[0]) < n:
+        warnings.warn('only {} of {} cells fit on the grid with minimum distance {}'.format(len(pix[0]), n, dist))
+    grid = np.zeros(shape, dtype=_grid_dtype(len(pix[0]), dtype))
+    grid[tuple(pix)] = np.arange(1, len(pix[0]) + 1)
+    return grid
+
+
+def _lattice_scales(dist, ndim):
+    """
+    Integer scale factors s of the lattice of points k * s with integer k and even sum(k), and the minimum
+    distance between its points. With s = (dist / 2, dist * sqrt(3) / 2) this is the hexagonal lattice and with
+    s = dist / sqrt(2) * (1, 1, 1) the face-centred cubic lattice; the integer scales closest to these, for which
+    the minimum distance is at least dist, are searched in a small window.
+    """
+    ideal = [dist / 2, dist * np.sqrt(3) / 2] if ndim == 2 else [dist / np.sqrt(2)] * 3
+    window = [np.arange(max(int(np.floor(x)) - 2, 1), int(np.ceil(x)) + 3) for x in ideal]
+    scales = np.stack([g.ravel() for g in np.meshgrid(*window, indexing='ij')], axis=1)
+    # nearest neighbours are at offsets k with two entries +-1 or one entry +-2
+    pairs = [np.sqrt(scales[:, i] ** 2 + scales[:, j] ** 2) for i, j in itertools.combinations(range(ndim), 2)]
+    spacing = np.min(np.column_stack(pairs + [2 * scales]), axis=1)
+    valid = np.flatnonzero(spacing >= dist)
+    best = valid[np.argmin(np.prod(scales[valid], axis=1))]
+    return scales[best], spacing[best]
+
+
+def _seed_cells_lattice(shape, n, pad, dist, rng, dtype=None):
+    ndim = len(shape)
+    inner = np.array([max(s - 2 * pad, 0) for s in shape])
+    # a lattice spacing that spreads n cells over the grid, or dist when that is larger
+    unit = np.sqrt(3) / 2 if ndim == 2 else 1 / np.sqrt(2)
+    spacing = max(dist, (np.prod(inner) / max(n, 1) / unit) ** (1 / ndim), 1)
+    while True:
+        scales, lattice_dist = _lattice_scales(spacing, ndim)
+        origin = rng.integers(0, scales)
+        parity = rng.integers(2)
+        ks = np.meshgrid(*(np.arange(-(-(m - o) // s)) for m, o, s in zip(inner, origin, scales)), indexing='ij')
+        ks = np.stack([k.ravel() for k in ks], axis=1)
+        ks = ks[ks.sum(axis=1) % 2 == parity]
+        # integer scales round the spacing up, shrink it until n cells fit
+        if len(ks) >= n or spacing <= max(dist, 1):
+            break
+        spacing = max(0.95 * spacing, dist, 1)
+    pix = origin + ks * scales
+    if len(pix) > n:
+        pix = pix[rng.choice(len(pix), n, replace=False)]
+    elif len(pix) < n:
+        warnings.warn('only {} of {} cells fit on the grid with minimum distance {}'.format(len(pix), n, dist))
+    # each pixel moves at most jitter * sqrt(ndim), which keeps all distances at least dist; pixels that would
+    # leave the grid are not moved
+    jitter = int((lattice_dist - dist) / (2 * np.sqrt(ndim)))
+    if jitter > 0:
+        moved = pix + rng.integers(-jitter, jitter + 1, pix.shape)
+        inside = np.all((moved >= 0) & (moved < inner), axis=1)
+        pix[inside] = moved[inside]
+    grid = np.zeros(shape, dtype=_grid_dtype(len(pix), dtype))
+    grid[tuple(pix.T + pad)] = np.arange(1, len(pix) + 1)
+    return grid
+
+
+@jit(nopython=True, cache=True)
+def _poisson_disk(x0, x1, y0, y1, dist, k, seed):
+    # Bridson's algorithm on the pixel lattice; the spatial hash has cells of size dist/sqrt(2)
+    # such that each hash cell holds at most one seed
+    np.random.seed(seed)
+    if x1 <= x0 or y1 <= y0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cs = dist / np.sqrt(2)
+    gw = int(np.ceil((x1 - x0) / cs))
+    gh = int(np.ceil((y1 - y0) / cs))
+    cells = -np.ones((gw, gh), dtype=np.int64)
+    px = np.empty(gw * gh, dtype=np.int64)
+    py = np.empty(gw * gh, dtype=np.int64)
+    active = np.empty(gw * gh, dtype=np.int64)
+    px[0] = np.random.randint(x0, x1)
+    py[0] = np.random.randint(y0, y1)
+    cells[int((px[0] - x0) / cs), int((py[0] - y0) / cs)] = 0
+    active[0] = 0
+    n = 1
+    n_active = 1
+    while n_active > 0:
+        a = np.random.randint(0, n_active)
+        i = active[a]
+        found = False
+        for _ in range(k):
+            rad = dist * (1 + np.random.random())
+            phi = 2 * np.pi * np.random.random()
+            x = int(np.round(px[i] + rad * np.cos(phi)))
+            y = int(np.round(py[i] + rad * np.sin(phi)))
+            if x < x0 or x >= x1 or y < y0 or y >= y1:
+                continue
+            gx = int((x - x0) / cs)
+            gy = int((y - y0) / cs)
+            if cells[gx, gy] >= 0:
+                continue
+            add = True
+            for gi in range(max(gx - 2, 0), min(gx + 3, gw)):
+                for gj in range(max(gy - 2, 0), min(gy + 3, gh)):
+                    j = cells[gi, gj]
+                    if j >= 0 and (px[j] - x) ** 2 + (py[j] - y) ** 2 < dist ** 2:
+                        add = False
+                        break
+                if not add:
+                    break
+            if add:
+                px[n] = x
+                py[n] = y
+                cells[gx, gy] = n
+                active[n_active] = n
+                n += 1
+                n_active += 1
+                found = True
+                break
+        if not found:
+            n_active -= 1
+            active[a] = active[n_active]
+    return px[:n], py[:n]
+
+
+@jit(nopython=True, cache=True)
+def _poisson_disk_3d(x0, x1, y0, y1, z0, z1, dist, k, seed):
+    # same as _poisson_disk, with hash cells of size dist/sqrt(3)
+    np.random.seed(seed)
+    if x1 <= x0 or y1 <= y0 or z1 <= z0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cs = dist / np.sqrt(3)
+    gw = int(np.ceil((x1 - x0) / cs))
+    gh = int(np.ceil((y1 - y0) / cs))
+    gd = int(np.ceil((z1 - z0) / cs))
+    cells = -np.ones((gw, gh, gd), dtype=np.int64)
+    px = np.empty(gw * gh * gd, dtype=np.int64)
+    py = np.empty(gw * gh * gd, dtype=np.int64)
+    pz = np.empty(gw * gh * gd, dtype=np.int64)
+    active = np.empty(gw * gh * gd, dtype=np.int64)
+    px[0] = np.random.randint(x0, x1)
+    py[0] = np.random.randint(y0, y1)
+    pz[0] = np.random.randint(z0, z1)
+    cells[int((px[0] - x0) / cs), int((py[0] - y0) / cs), int((pz[0] - z0) / cs)] = 0
+    active[0] = 0
+    n = 1
+    n_active = 1
+    while n_active > 0:
+        a = np.random.randint(0, n_active)
+        i = active[a]
+        found = False
+        for _ in range(k):
+            rad = dist * (1 + np.random.random())
+            cos_theta = 2 * np.random.random() - 1
+            sin_theta = np.sqrt(1 - cos_theta ** 2)
+            phi = 2 * np.pi * np.random.random()
+            x = int(np.round(px[i] + rad * sin_theta * np.cos(phi)))
+            y = int(np.round(py[i] + rad * sin_theta * np.sin(phi)))
+            z = int(np.round(pz[i] + rad * cos_theta))
+            if x < x0 or x >= x1 or y < y0 or y >= y1 or z < z0 or z >= z1:
+                continue
+            gx = int((x - x0) / cs)
+            gy = int((y - y0) / cs)
+            gz = int((z - z0) / cs)
+            if cells[gx, gy, gz] >= 0:
+                continue
+            add = True
+            for gi in range(max(gx - 2, 0), min(gx + 3, gw)):
+                for gj in range(max(gy - 2, 0), min(gy + 3, gh)):
+                    for gk in range(max(gz - 2, 0), min(gz + 3, gd)):
+                        j = cells[gi, gj, gk]
+                        if j >= 0 and (px[j] - x) ** 2 + (py[j] - y) ** 2 + (pz[j] - z) ** 2 < dist ** 2:
+                            add = False
+                            break
+                    if not add:
+                        break
+                if not add:
+                    break
+            if add:
+                px[n] = x
+                py[n] = y
+                pz[n] = z
+                cells[gx, gy, gz] = n
+                active[n_active] = n
+                n += 1
+                n_active += 1
+                found = True
+                break
+        if not found:
+            n_active -= 1
+            active[a] = active[n_active]
+    return px[:n], py[:n], pz[:n]
+
+
+@jit(nopython=True, cache=True)
+def _dart_throwing(x0, x1, y0, y1, z0, z1, ndim, dist, n, tries, seed):
+    # random positions are accepted when no earlier seed lies within dist, checked with the spatial hash of
+    # _poisson_disk and _poisson_disk_3d (2D grids have z0 = 0 and z1 = 1); stops after n seeds or tries positions
+    np.random.seed(seed)
+    if x1 <= x0 or y1 <= y0 or z1 <= z0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cs = dist / np.sqrt(ndim)
+    gw = int(np.ceil((x1 - x0) / cs))
+    gh = int(np.ceil((y1 - y0) / cs))
+    gd = int(np.ceil((z1 - z0) / cs))
+    cells = np.full((gw, gh, gd), -1, dtype=np.int32)
+    px = np.empty(n, dtype=np.int64)
+    py = np.empty(n, dtype=np.int64)
+    pz = np.empty(n, dtype=np.int64)
+    m = 0
+    for _ in range(tries):
+        if m == n:
+            break
+        x = np.random.randint(x0, x1)
+        y = np.random.randint(y0, y1)
+        z = np.random.randint(z0, z1)
+        gx = int((x - x0) / cs)
+        gy = int((y - y0) / cs)
+        gz = int((z - z0) / cs)
+        if cells[gx, gy, gz] >= 0:
+            continue
         add = True
-        for p in pix:
-            if ((p[0] - x) ** 2 + (p[1] - y) ** 2) < dist ** 2:
-                add = False
+        for gi in range(max(gx - 2, 0), min(gx + 3, gw)):
+            for gj in range(max(gy - 2, 0), min(gy + 3, gh)):
+                for gk in range(max(gz - 2, 0), min(gz + 3, gd)):
+                    j = cells[gi, gj, gk]
+                    if j >= 0 and (px[j] - x) ** 2 + (py[j] - y) ** 2 + (pz[j] - z) ** 2 < dist ** 2:
+                        add = False
+                        break
+                if not add:
+                    break
+            if not add:
                 break
         if add:
-            pix.append((x, y))
-        it += 1
-        if it > maxit * n:
-            break
-    grid = np.zeros((w, h))
-    for i, (x, y) in enumerate(pix, 1):
-        grid[x, y] = i
-    return grid
+            px[m] = x
+            py[m] = y
+            pz[m] = z
+            cells[gx, gy, gz] = m
+            m += 1
+    return px[:m], py[:m], pz[:m]
+
+
+def initialize_batch(params, fn_pattern, root_seed=None, processes=None, max_pending=None):
+    """
+    Generate a batch of initial conditions in parallel. Each job seeds cells with seed_cells (or seed_cells_3d)
+    and grows them with the chosen method. Every job gets its own random stream, spawned from root_seed, so the
+    grids only depend on root_seed and the parameters, not on the number of processes or the order in which
+    jobs finish. Grids are saved with write_to_tiff by the worker that generated them.
+
+    Job parameters:
+        shape: grid shape, (w, h) or (w, h, d)
+        n: number of cells
+        method: 'DLA' (default), 'round', 'confluent' or 'seed' (no growth)
+        volume: target volume for 'DLA', maximum volume for 'confluent' (optional)
+        r: radius for 'round'
+        overlap: overlap policy for 'round' (default 'last')
+        pad, dist, maxit, dtype, packing: passed to seed_cells
+        maxit_growth: maximum number of DLA steps
+
+    Args:
+        params: list with a dictionary of parameters per job, or a dictionary with a list of values per parameter,
+            in which case all combinations are generated
+        fn_pattern: filename pattern, formatted with the job number and the job parameters,
+            e.g. 'init_{0:03d}_n{n}.tif'
+        root_seed: seed from which the random streams of the jobs are spawned
+        processes: number of worker processes (defaults to the number of cores)
+        max_pending: maximum number of jobs in flight (defaults to twice the number of processes)
+
+    Returns: list with the filename of each job
+
+    """
+    if isinstance(params, dict):
+        keys = list(params)
+        params = [dict(zip(keys, values)) for values in itertools.product(*(params[k] for k in keys))]
+    if processes is None:
+        processes = os.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * processes
+    seeds = np.random.SeedSequence(root_seed).spawn(len(params))
+    fns = [fn_pattern.format(i, **job) for i, job in enumerate(params)]
+    pending = deque()
+    # spawn workers, forking is unsafe once numba has started its thread pool
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for job, seed, fn in zip(params, seeds, fns):
+            if len(pending) >= max_pending:
+                pending.popleft().result()
+            pending.append(executor.submit(_initialize_job, job, seed, fn))
+        while pending:
+            pending.popleft().result()
+    return fns
+
+
+def _initialize_job(job, seed, fn):
+    rng = np.random.default_rng(seed)
+    shape = tuple(job['shape'])
+    seed_args = {k: job[k] for k in ('pad', 'dist', 'maxit', 'dtype', 'packing') if k in job}
+    if len(shape) == 3:
+        grid = seed_cells_3d(*shape, n=job['n'], rng=rng, **seed_args)
+    else:
+        grid = seed_cells(*shape, n=job['n'], rng=rng, **seed_args)
+    method = job.get('method', 'DLA')
+    if method == 'DLA':
+        grid = grow_cells_DLA(grid, job['volume'], job.get('maxit_growth'), rng=rng)
+    elif method == 'round':
+        grid = grow_cells_round(grid, job['r'], job.get('overlap', 'last'))
+    elif method == 'confluent':
+        grid = grow_cells_confluent(grid, job.get('volume'))
+    elif method != 'seed':
+        raise ValueError('unknown method {}, use DLA, round, confluent or seed'.format(method))
+    write_to_tiff(grid, fn)
 
 
 def write_to_tiff(grid, fn):
     """
-    Save grid to tiff.
+    Save grid to tiff. 3D grids are saved as multi-page tiff with one page per slice along the first axis.
+    The grid is stored with the smallest of uint8, uint16 and uint32 that holds all values.
 
     Args:
         grid: CPM grid
         fn: filename
 
     """
-    if grid.max() < 256:
-        imageio.imwrite(fn, grid.astype(np.uint8), format='tiff')
+    # imported here, such that seeding and growing cells does not require imageio
+    import imageio
+    if grid.max() < 2 ** 8:
+        grid = grid.astype(np.uint8)
+    elif grid.max() < 2 ** 16:
+        grid = grid.astype(np.uint16)
     else:
-        imageio.imwrite(fn, grid.astype(np.uint16), format='tiff')
-
+        grid = grid.astype(np.uint32)
+    if grid.ndim == 3:
+        imageio.volwrite(fn, grid, format='tiff')
+    else:
+        imageio.imwrite(fn, grid, format='tiff')
@@ -0,0 +1,470 @@
+import glob
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class SnapshotStore(object):
+    """ On-disk store for sigma/tau time series
+
+    Frames are stored in a directory as raw arrays (sigma.dat, tau.dat and mcs.dat) together with a small json
+    header. The files grow in chunks of frames and are accessed through numpy memory maps, such that any frame
+    or range of frames can be read without loading the run into memory.
+
+    The store can be iterated over, yielding (sigma, tau, mcs) tuples, and the sigma and tau attributes are
+    arrays with all frames, so a store can be passed directly to e.g. draw_cpm_grids or animate_cpm_sim_mpl:
+
+    >>> with SnapshotStore('run', mode='w', shape=(200, 200)) as store:
+    ...     store.append(sigma, tau, mcs)
+    >>> draw_cpm_grids(SnapshotStore('run'), colormap, 'frame_{:05d}.png')
+
+    :param path: directory of the store
+    :param mode: 'r' to read, 'a' to append to a (new) store, 'w' to create a new store
+    :param shape: grid shape, only required when creating a store
+    :param dtype: dtype of sigma, only used when creating a store
+    :param tau_dtype: dtype of tau, only used when creating a store (defaults to dtype)
+    :param chunk: number of frames by which the files grow
+    """
+
+    def __init__(self, path, mode='r', shape=None, dtype=np.int32, tau_dtype=None, chunk=64):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError('unknown mode {}, use r, a or w'.format(mode))
+        self.path = path
+        self.mode = mode
+        if mode == 'w' or (mode == 'a' and not os.path.exists(self._fn('header.json'))):
+            if shape is None:
+                raise ValueError('shape is required to create a new store')
+            if tau_dtype is None:
+                tau_dtype = dtype
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.header = {'shape': list(shape), 'dtype': np.dtype(dtype).str, 'tau_dtype': np.dtype(tau_dtype).str,
+                           'count': 0, 'capacity': 0, 'chunk': chunk}
+            for name in ('sigma.dat', 'tau.dat', 'mcs.dat'):
+                open(self._fn(name), 'wb').close()
+            self._write_header()
+        else:
+            with open(self._fn('header.json')) as f:
+                self.header = json.load(f)
+        self.shape = tuple(self.header['shape'])
+        self._map()
+
+    def _fn(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_header(self):
+        _write_json(self._fn('header.json'), self.header)
+
+    def _map(self):
+        """ (Re)create memory maps for all frames in the files """
+        n = self.header['capacity'] if self.mode != 'r' else self.header['count']
+        mode = 'r' if self.mode == 'r' else 'r+'
+        if n == 0:
+            self._sigma = np.empty((0,) + self.shape, dtype=self.header['dtype'])
+            self._tau = np.empty((0,) + self.shape, dtype=self.header['tau_dtype'])
+            self._mcs = np.empty(0, dtype=np.int64)
+            return
+        self._sigma = np.memmap(self._fn('sigma.dat'), dtype=self.header['dtype'], mode=mode, shape=(n,) + self.shape)
+        self._tau = np.memmap(self._fn('tau.dat'), dtype=self.header['tau_dtype'], mode=mode, shape=(n,) + self.shape)
+        self._mcs = np.memmap(self._fn('mcs.dat'), dtype=np.int64, mode=mode, shape=(n,))
+
+    def _grow(self):
+        capacity = self.header['capacity'] + self.header['chunk']
+        size = int(np.prod(self.shape))
+        self.flush()
+        for name, dtype in (('sigma.dat', self.header['dtype']), ('tau.dat', self.header['tau_dtype']),
+                            ('mcs.dat', None)):
+            with open(self._fn(name), 'r+b') as f:
+                if dtype is None:
+                    f.truncate(capacity * np.dtype(np.int64).itemsize)
+                else:
+                    f.truncate(capacity * size * np.dtype(dtype).itemsize)
+        self.header['capacity'] = capacity
+        self._map()
+
+    def append(self, sigma, tau, mcs=None):
+        """ Add frame to the store
+
+        :param sigma: array with cell ids
+        :param tau: array with cell types
+        :param mcs: Monte Carlo step of the frame (defaults to the frame number)
+        """
+        if self.mode == 'r':
+            raise IOError('cannot append to a store opened in read mode')
+        n = self.header['count']
+        if n == self.header['capacity']:
+            self._grow()
+        self._sigma[n] = sigma
+        self._tau[n] = tau
+        self._mcs[n] = n if mcs is None else mcs
+        self.header['count'] = n + 1
+        self._write_header()
+
+    def flush(self):
+        """ Write pending changes to disk """
+        for a in (self._sigma, self._tau, self._mcs):
+            if isinstance(a, np.memmap):
+                a.flush()
+
+    def close(self):
+        """ Flush and release the memory maps """
+        if self.mode != 'r':
+            self.flush()
+            self._write_header()
+        self._sigma = self._tau = self._mcs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def sigma(self):
+        """ Memory mapped array with sigma of all frames """
+        return self._sigma[:len(self)]
+
+    @property
+    def tau(self):
+        """ Memory mapped array with tau of all frames """
+        return self._tau[:len(self)]
+
+    @property
+    def mcs(self):
+        """ Memory mapped array with the Monte Carlo step of all frames """
+        return self._mcs[:len(self)]
+
+    def __len__(self):
+        return self.header['count']
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)) and not -len(self) <= item < len(self):
+            raise IndexError('frame {} out of range for store with {} frames'.format(item, len(self)))
+        return self.sigma[item], self.tau[item], self.mcs[item]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class DeltaTrajectory(object):
+    """ Delta-encoded on-disk store for sigma/tau time series
+
+    Only a small fraction of the lattice sites changes between consecutive frames of a CPM simulation. Therefore,
+    a DeltaTrajectory stores a full keyframe (in a SnapshotStore) once every keyframe_interval frames, and for
+    every other frame only the list of changed sites with their new sigma and tau. Frames are reconstructed by
+    applying these changes to the nearest preceding keyframe.
+
+    Iterating over a trajectory reconstructs the frames sequentially and yields (sigma, tau, mcs) tuples, while the
+    sigma and tau attributes give lazy per-frame access, so a trajectory can be passed directly to e.g.
+    draw_cpm_grids or stream_cpm_sim_mpl.
+
+    :param path: directory of the trajectory
+    :param mode: 'r' to read, 'a' to append to a (new) trajectory, 'w' to create a new trajectory
+    :param shape: grid shape, only required when creating a trajectory
+    :param dtype: dtype of sigma, only used when creating a trajectory
+    :param tau_dtype: dtype of tau, only used when creating a trajectory (defaults to dtype)
+    :param keyframe_interval: number of frames between keyframes, only used when creating a trajectory
+    """
+
+    def __init__(self, path, mode='r', shape=None, dtype=np.int32, tau_dtype=None, keyframe_interval=100):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError('unknown mode {}, use r, a or w'.format(mode))
+        self.path = path
+        self.mode = mode
+        if mode == 'w' or (mode == 'a' and not os.path.exists(self._fn('header.json'))):
+            if shape is None:
+                raise ValueError('shape is required to create a new trajectory')
+            if tau_dtype is None:
+                tau_dtype = dtype
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            index_dtype = np.uint32 if np.prod(shape) < 2 ** 32 else np.int64
+            self.header = {'shape': list(shape), 'dtype': np.dtype(dtype).str, 'tau_dtype': np.dtype(tau_dtype).str,
+                           'index_dtype': np.dtype(index_dtype).str, 'keyframe_interval': keyframe_interval,
+                           'count': 0}
+            for name in ('index.dat', 'sigma.dat', 'tau.dat', 'offsets.dat', 'mcs.dat'):
+                open(self._fn(name), 'wb').close()
+            self.keyframes = SnapshotStore(self._fn('keyframes'), 'w', shape, dtype, tau_dtype)
+            _write_json(self._fn('header.json'), self.header)
+        else:
+            with open(self._fn('header.json')) as f:
+                self.header = json.load(f)
+            self.keyframes = SnapshotStore(self._fn('keyframes'), 'r' if mode == 'r' else 'a')
+        self.shape = tuple(self.header['shape'])
+        n = self.header['count']
+        self._offsets = list(np.fromfile(self._fn('offsets.dat'), dtype=np.int64)[:n])
+        self._mcs = list(np.fromfile(self._fn('mcs.dat'), dtype=np.int64)[:n])
+        self._maps = None
+        self._prev = None
+        self._files = None
+        if mode != 'r':
+            self._files = {name: open(self._fn(name), 'ab')
+                           for name in ('index.dat', 'sigma.dat', 'tau.dat', 'offsets.dat', 'mcs.dat')}
+            if n > 0:
+                self._prev = self[n - 1][:2]
+
+    def _fn(self, name):
+        return os.path.join(self.path, name)
+
+    def append(self, sigma, tau, mcs=None):
+        """ Add frame to the trajectory
+
+        :param sigma: array with cell ids
+        :param tau: array with cell types
+        :param mcs: Monte Carlo step of the frame (defaults to the frame number)
+        """
+        if self.mode == 'r':
+            raise IOError('cannot append to a trajectory opened in read mode')
+        n = len(self)
+        mcs = n if mcs is None else mcs
+        sigma = np.ascontiguousarray(sigma, dtype=self.header['dtype'])
+        tau = np.ascontiguousarray(tau, dtype=self.header['tau_dtype'])
+        if n % self.header['keyframe_interval'] == 0:
+            self.keyframes.append(sigma, tau, mcs)
+        if n == 0:
+            changed = np.empty(0, dtype=np.int64)
+        else:
+            changed = np.flatnonzero((sigma != self._prev[0]) | (tau != self._prev[1]))
+        changed.astype(self.header['index_dtype']).tofile(self._files['index.dat'])
+        sigma.reshape(-1)[changed].tofile(self._files['sigma.dat'])
+        tau.reshape(-1)[changed].tofile(self._files['tau.dat'])
+        self._offsets.append((self._offsets[-1] if n > 0 else 0) + len(changed))
+        self._mcs.append(mcs)
+        np.array(self._offsets[-1:], dtype=np.int64).tofile(self._files['offsets.dat'])
+        np.array(self._mcs[-1:], dtype=np.int64).tofile(self._files['mcs.dat'])
+        self._prev = (sigma.copy(), tau.copy())
+        self.header['count'] = n + 1
+        _write_json(self._fn('header.json'), self.header)
+
+    def flush(self):
+        """ Write pending changes to disk """
+        if self._files is not None:
+            for f in self._files.values():
+                f.flush()
+        self.keyframes.flush()
+
+    def close(self):
+        """ Flush and close all files """
+        self.flush()
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+        self.keyframes.close()
+        self._maps = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def mcs(self):
+        """ Array with the Monte Carlo step of all frames """
+        return np.array(self._mcs, dtype=np.int64)
+
+    @property
+    def sigma(self):
+        """ Lazy sequence with sigma of all frames """
+        return _FrameView(self, 0)
+
+    @property
+    def tau(self):
+        """ Lazy sequence with tau of all frames """
+        return _FrameView(self, 1)
+
+    def _changes(self):
+        """ Memory maps with the changed sites and their new sigma and tau """
+        total = self._offsets[-1] if len(self) > 0 else 0
+        if self._maps is None or len(self._maps[0]) != total:
+            self.flush()
+            self._maps = tuple(_map_file(self._fn(name), self.header[key], total) for name, key in
+                               (('index.dat', 'index_dtype'), ('sigma.dat', 'dtype'), ('tau.dat', 'tau_dtype')))
+        return self._maps
+
+    def changes(self, i):
+        """ Sites that changed in frame i compared to frame i - 1
+
+        :param i: frame number
+        :return: flat indices of the changed sites, their new sigma and their new tau
+        """
+        index, sigma, tau = self._changes()
+        start = self._offsets[i - 1] if i > 0 else 0
+        end = self._offsets[i]
+        return index[start:end], sigma[start:end], tau[start:end]
+
+    def _apply(self, sigma, tau, i):
+        index, new_sigma, new_tau = self.changes(i)
+        sigma.reshape(-1)[index] = new_sigma
+        tau.reshape(-1)[index] = new_tau
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('frame {} out of range for trajectory with {} frames'.format(i, len(self)))
+        k = i // self.header['keyframe_interval']
+        sigma, tau, _ = self.keyframes[k]
+        sigma = np.array(sigma)
+        tau = np.array(tau)
+        for j in range(k * self.header['keyframe_interval'] + 1, i + 1):
+            self._apply(sigma, tau, j)
+        return sigma, tau, self._mcs[i]
+
+    def __iter__(self):
+        if len(self) == 0:
+            return
+        sigma, tau, mcs = self[0]
+        yield sigma.copy(), tau.copy(), mcs
+        for i in range(1, len(self)):
+            self._apply(sigma, tau, i)
+            yield sigma.copy(), tau.copy(), self._mcs[i]
+
+
+class _FrameView(object):
+    """ Sequence with one field of the frames of a DeltaTrajectory """
+
+    def __init__(self, trajectory, field):
+        self.trajectory = trajectory
+        self.field = field
+
+    def __len__(self):
+        return len(self.trajectory)
+
+    def __getitem__(self, i):
+        return self.trajectory[i][self.field]
+
+    def __iter__(self):
+        for frame in self.trajectory:
+            yield frame[self.field]
+
+
+def iter_frame_directory(path, pattern='*.tif*', tau_pattern=None, dtype=None, workers=None, prefetch=None):
+    """ Iterate over a directory with one image file per frame, e.g. as written by write_to_tiff
+
+    Files are ordered naturally (frame_2 before frame_10) and decoded in a pool of threads, with at most prefetch
+    frames decoded ahead of the frame that is being used. The MCS of a frame is the last number in its filename
+    (or the frame number when the filename has no number). When a tau pattern is given, the tau files are paired
+    with the sigma files in the same order.
+
+    :param path: directory with the frames
+    :param pattern: glob pattern of the sigma files
+    :param tau_pattern: glob pattern of the tau files (no tau when None)
+    :param dtype: dtype of the returned arrays (defaults to the dtype of the files)
+    :param workers: number of decoding threads (defaults to the number of cores)
+    :param prefetch: maximum number of frames decoded ahead (defaults to twice the number of workers)
+    :return: generator with (sigma, tau, mcs) tuples, tau is None without tau pattern
+    """
+    sigma_fns, tau_fns, mcs = _frame_files(path, pattern, tau_pattern)
+    if workers is None:
+        workers = os.cpu_count()
+    if prefetch is None:
+        prefetch = 2 * workers
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        for i in range(len(sigma_fns)):
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_read_frame, sigma_fns[i], tau_fns[i], mcs[i], dtype))
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_frame_directory(path, pattern='*.tif*', tau_pattern=None, dtype=None, workers=None):
+    """ Load a directory with one image file per frame into stacked arrays
+
+    Frames are decoded in a pool of threads directly into preallocated arrays, see iter_frame_directory for the
+    ordering of the files.
+
+    :param path: directory with the frames
+    :param pattern: glob pattern of the sigma files
+    :param tau_pattern: glob pattern of the tau files (no tau when None)
+    :param dtype: dtype of the returned arrays (defaults to the dtype of the first file)
+    :param workers: number of decoding threads (defaults to the number of cores)
+    :return: sigma array (frames first), tau array (None without tau pattern) and array with the MCS of each frame
+    """
+    sigma_fns, tau_fns, mcs = _frame_files(path, pattern, tau_pattern)
+    if len(sigma_fns) == 0:
+        raise IOError('no files matching {} in {}'.format(pattern, path))
+    first = _read_grid(sigma_fns[0])
+    sigma = np.empty((len(sigma_fns),) + first.shape, dtype=first.dtype if dtype is None else dtype)
+    tau = None
+    if tau_pattern is not None:
+        first_tau = _read_grid(tau_fns[0])
+        tau = np.empty((len(tau_fns),) + first_tau.shape, dtype=first_tau.dtype if dtype is None else dtype)
+
+    def load(i):
+        sigma[i] = _read_grid(sigma_fns[i])
+        if tau is not None:
+            tau[i] = _read_grid(tau_fns[i])
+
+    with ThreadPoolExecutor(workers) as executor:
+        # consume the results, such that errors are raised
+        list(executor.map(load, range(len(sigma_fns))))
+    return sigma, tau, np.array(mcs, dtype=np.int64)
+
+
+def _natural_key(fn):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(fn))]
+
+
+def _frame_files(path, pattern, tau_pattern):
+    """ Naturally sorted sigma and tau files and the MCS of each frame """
+    sigma_fns = sorted(glob.glob(os.path.join(path, pattern)), key=_natural_key)
+    if tau_pattern is None:
+        tau_fns = [None] * len(sigma_fns)
+    else:
+        tau_fns = sorted(glob.glob(os.path.join(path, tau_pattern)), key=_natural_key)
+        # without this, a pattern like '*.tif' would also match the tau files
+        tau_set = set(tau_fns)
+        sigma_fns = [fn for fn in sigma_fns if fn not in tau_set]
+        if len(tau_fns) != len(sigma_fns):
+            raise IOError('found {} sigma files and {} tau files'.format(len(sigma_fns), len(tau_fns)))
+    mcs = []
+    for i, fn in enumerate(sigma_fns):
+        numbers = re.findall(r'\d+', os.path.basename(fn))
+        mcs.append(int(numbers[-1]) if numbers else i)
+    return sigma_fns, tau_fns, mcs
+
+
+def _read_frame(sigma_fn, tau_fn, mcs, dtype):
+    sigma = _read_grid(sigma_fn, dtype)
+    tau = None if tau_fn is None else _read_grid(tau_fn, dtype)
+    return sigma, tau, mcs
+
+
+def _read_grid(fn, dtype=None):
+    """ Read a 2D image or a 3D multi-page tiff """
+    if tifffile is not None and fn.lower().endswith(('.tif', '.tiff')):
+        grid = tifffile.imread(fn)
+    else:
+        # imported here, such that the snapshot stores do not require imageio
+        import imageio.v2 as imageio
+        grid = np.asarray(imageio.imread(fn))
+    return grid if dtype is None else grid.astype(dtype)
+
+
+def _map_file(fn, dtype, n):
+    if n == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(fn, dtype=dtype, mode='r', shape=(n,))
+
+
+def _write_json(fn, obj):
+    # replace the file in one go, such that readers never see a partially written file
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(fn + '.tmp', fn)
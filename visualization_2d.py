@@ -1,209 +1,595 @@
 import math
 import numpy as np
-import copy, os
+import copy, os, time
+import functools
+import multiprocessing
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from numba import jit
 
 try:
     from PIL import Image, ImageDraw, ImageFont
 except ImportError:
     raise ('cannot draw without PIL')
 
+try:
+    from mahotas import labeled
+except ImportError:
+    labeled = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
 __FONTPATH__ = '/usr/share/fonts/truetype/freefont/FreeSans.ttf'
 
 
 def get_2d_projection(sigma, tau, projection):
     """ Draw 2D projection of a 3D cpm simulation
 
+    For every line of voxels along the projection axis the first ('-') or last ('+') non-zero voxel is
+    looked up with a single argmax over the volume, after which sigma and tau are gathered from that voxel.
+
     :param sigma: 3D array with cell ids
     :param tau: 3D array with cell types
     :param projection: string with projection plane (x, y, or z) and direction ('+' = top and '-' = bottom)
     """
-    top = -1
-    if '-' in projection:
-        top = 0
-    if 'x' in projection:
-        sigma_2d = np.array([[sigma[:, y, z][sigma[:, y, z] > 0][top] if np.any(sigma[:, y, z] > 0) else 0
-                              for z in range(sigma.shape[2])] for z in range(sigma.shape[1])])
-    elif 'y' in projection:
-        sigma_2d = np.array([[sigma[x, :, z][sigma[x, :, z] > 0][top] if np.any(sigma[x, :, z] > 0) else 0
-                              for z in range(sigma.shape[2])] for x in range(sigma.shape[0])])
-    elif 'z' in projection:
-        sigma_2d = np.array([[sigma[x, y, :][sigma[x, y, :] > 0][top] if np.any(sigma[x, y, :] > 0) else 0
-                              for y in range(sigma.shape[1])] for x in range(sigma.shape[0])])
-    else:
+    axes = {'x': 0, 'y': 1, 'z': 2}
+    axis = [axes[a] for a in axes if a in projection]
+    if len(axis) == 0:
         print('Unrecognized projection {}'.format(projection))
         return
-    # map tau
-    tau_2d = np.zeros_like(sigma_2d)
-    for s in np.unique(sigma_2d):
-        px, py, pz = np.array(np.where(sigma == s))[:, 0]
-        tau_2d[np.where(sigma_2d == s)] = tau[px, py, pz]
+    axis = axis[0]
+    mask = sigma > 0
+    if '-' in projection:
+        idx = np.argmax(mask, axis=axis)
+    else:
+        idx = sigma.shape[axis] - 1 - np.argmax(np.flip(mask, axis=axis), axis=axis)
+    idx = np.expand_dims(idx, axis)
+    empty = ~np.any(mask, axis=axis)
+    sigma_2d = np.take_along_axis(sigma, idx, axis=axis).squeeze(axis)
+    tau_2d = np.take_along_axis(tau, idx, axis=axis).squeeze(axis)
+    sigma_2d[empty] = 0
+    tau_2d[empty] = 0
     return sigma_2d, tau_2d
 
 
-def draw_2d_projection(sigma, tau, colormap, fn, projection='+z', scale=1, border_color=None, draw_border=True):
+def draw_2d_projection(sigma, tau, colormap, fn=None, projection='+z', scale=1, border_color=None, draw_border=True):
     """ Draw 2D projection of a 3D cpm simulation
 
     :param sigma: 3D array with cell ids
     :param tau: 3D array with cell types
     :param colormap: dictionary with tau as keys and colors (rgb tuples) as values
-    :param fn: filename used for saving
+    :param fn: filename used for saving (the image is not saved when None)
     :param projection: string with projection plane (x, y, or z) and direction ('+' = top and '-' = bottom)
     :param scale: image scaling
     :param border_color: color of the cell borders
     :param draw_border: draw cell borders
+    :return: Canvas with the image
     """
     sigma_2d, tau_2d = get_2d_projection(sigma, tau, projection)
-    draw_cpm_grid(sigma_2d, tau_2d, colormap, fn, scale, border_color, draw_border)
+    return draw_cpm_grid(sigma_2d, tau_2d, colormap, fn, scale, border_color, draw_border)
+
+
+_PROJECTIONS = ('+x', '+y', '+z', '-x', '-y', '-z')
+
+
+def get_2d_projections(sigma, tau):
+    """ Compute all six 2D projections of a 3D cpm simulation in a single pass over the volume
+
+    Gives the same projections as get_2d_projection, together with the depth of the visible voxel, i.e. its
+    distance to the side of the volume that the projection looks at (-1 where no voxel is visible).
 
+    :param sigma: 3D array with cell ids
+    :param tau: 3D array with cell types
+    :return: dictionary with projection ('+x', '-x', '+y', '-y', '+z', '-z') as keys and (sigma_2d, tau_2d, depth)
+        tuples as values
+    """
+    first, last = _surface_index(np.ascontiguousarray(sigma))
+    projections = {}
+    for axis, a in enumerate('xyz'):
+        n = sigma.shape[axis]
+        for direction, idx in (('-', first[axis]), ('+', last[axis])):
+            visible = idx >= 0
+            index = np.expand_dims(np.where(visible, idx, 0), axis)
+            sigma_2d = np.take_along_axis(sigma, index, axis=axis).squeeze(axis)
+            tau_2d = np.take_along_axis(tau, index, axis=axis).squeeze(axis)
+            sigma_2d[~visible] = 0
+            tau_2d[~visible] = 0
+            depth = np.where(visible, idx if direction == '-' else n - 1 - idx, -1)
+            projections[direction + a] = (sigma_2d, tau_2d, depth)
+    return projections
+
+
+def draw_3d_montage(sigma, tau, colormap, fn=None, scale=1, border_color=None, draw_border=True, shading=0.5,
+                    gap=10):
+    """ Draw all six 2D projections of a 3D cpm simulation as a depth-shaded montage
+
+    The projections are computed in a single pass over the volume (see get_2d_projections) and laid out in two
+    rows, with the '+' projections (+x, +y, +z) on top and the '-' projections below. Every projection is drawn
+    like draw_cpm_grid, after which cells are darkened with their distance to the side of the volume.
 
-def draw_cpm_grid(sigma, tau, colormap, fn, scale=1, border_color=None, draw_border=True):
+    :param sigma: 3D array with cell ids
+    :param tau: 3D array with cell types
+    :param colormap: dictionary with tau as keys and colors (rgb tuples) as values
+    :param fn: filename used for saving (the image is not saved when None)
+    :param scale: image scaling
+    :param border_color: color of the cell borders
+    :param draw_border: draw cell borders
+    :param shading: darkening of the deepest voxels (0 is no shading, 1 is black)
+    :param gap: white space between the projections in pixels
+    :return: Canvas with the image
+    """
+    if draw_border and labeled is None:
+        print('Drawing borders is only available when mahotas is installed!')
+        draw_border = False
+    if border_color is None:
+        border_color = (0, 0, 0)
+    projections = get_2d_projections(sigma, tau)
+    lut = _palette(colormap, tau)
+    size = int(scale * max(sigma.shape))
+    montage = np.full((2 * size + 3 * gap, 3 * size + 4 * gap, lut.shape[1]), 255, dtype=np.uint8)
+    for k, projection in enumerate(_PROJECTIONS):
+        sigma_2d, tau_2d, depth = projections[projection]
+        n = sigma.shape['xyz'.index(projection[1])]
+        # darken with depth, the visible surface closest to the viewer keeps its color
+        shade = 1 - shading * np.clip(depth, 0, None) / max(n - 1, 1)
+        panel = (lut[_upscale(tau_2d, scale)] * _upscale(shade, scale)[..., None]).astype(np.uint8)
+        if draw_border:
+            panel[labeled.borders(_upscale(sigma_2d, scale))] = border_color
+        row = gap + (k // 3) * (size + gap)
+        col = gap + (k % 3) * (size + gap)
+        montage[row:row + panel.shape[0], col:col + panel.shape[1]] = panel
+    canvas = Canvas(Image.fromarray(montage))
+    if fn is not None:
+        canvas.save(fn)
+    return canvas
+
+
+@jit(nopython=True, cache=True)
+def _surface_index(sigma):
+    # first and last non-zero voxel along each axis, -1 where the line of voxels is empty
+    w, h, d = sigma.shape
+    first_x = np.full((h, d), -1, dtype=np.int32)
+    last_x = np.full((h, d), -1, dtype=np.int32)
+    first_y = np.full((w, d), -1, dtype=np.int32)
+    last_y = np.full((w, d), -1, dtype=np.int32)
+    first_z = np.full((w, h), -1, dtype=np.int32)
+    last_z = np.full((w, h), -1, dtype=np.int32)
+    for x in range(w):
+        for y in range(h):
+            for z in range(d):
+                if sigma[x, y, z] == 0:
+                    continue
+                if first_x[y, z] < 0:
+                    first_x[y, z] = x
+                last_x[y, z] = x
+                if first_y[x, z] < 0:
+                    first_y[x, z] = y
+                last_y[x, z] = y
+                if first_z[x, y] < 0:
+                    first_z[x, y] = z
+                last_z[x, y] = z
+    return (first_x, first_y, first_z), (last_x, last_y, last_z)
+
+
+def draw_cpm_grid(sigma, tau, colormap, fn=None, scale=1, border_color=None, draw_border=True):
     """ Draw cpm grid
 
-    Draw cpm grid with any level of magnification and cell borders.
+    Draw cpm grid with any level of magnification and cell borders. Cells are colored with a single lookup in
+    a uint8 palette built from the colormap, and the grid is magnified with nearest-neighbour scaling, which
+    reduces to repeating pixels for integer scales.
 
     :param sigma: array with cell ids
     :param tau: array with cell types
     :param colormap: dictionary with tau as keys and colors (rgb tuples) as values
-    :param fn: filename used for saving
+    :param fn: filename used for saving (the image is not saved when None)
     :param scale: image scaling
     :param border_color: color of the cell borders
     :param draw_border: draw cell borders
+    :return: Canvas with the image, which can be annotated further before saving
     """
-    try:
-        from mahotas import labeled
-    except ImportError:
+    if draw_border and labeled is None:
         print('Drawing borders is only available when mahotas is installed!')
         draw_border = False
     if border_color is None:
         border_color = (0, 0, 0)
-    (nx, ny) = sigma.shape
-    sigma = sigma.astype(np.float)
-    types = tau.astype(np.float)
 
     # return empty image if sigma is empty
-    if np.sum(sigma) == 0:
-        im = Image.fromarray(255 * np.uint8(np.ones_like(sigma)))
-        im = im.resize((int(scale * ny), int(scale * nx)))
-        return np.asarray(im), sigma, np.zeros_like(sigma)
-
-    # resize sigma and tau
-    im = Image.fromarray(sigma)
-    im = im.resize((int(scale * ny), int(scale * nx)))
-    sigma = np.asarray(im)
-    tim = Image.fromarray(np.uint8(types))
-    tim = tim.resize((int(scale * ny), int(scale * nx)))
-    types = np.asarray(tim)
-
-    # used mahotas labeled function to retrieve the borders
-    if draw_border:
-        bim = labeled.borders(np.asarray(im))
+    if not np.any(sigma):
+        canvas = Canvas(Image.new('L', (int(scale * sigma.shape[1]), int(scale * sigma.shape[0])), 255))
     else:
-        bim = []
-    # combine the components created above into one image
-    imnew = colormap[0] * np.ones((int(scale * nx), int(scale * ny), len(colormap[0])))
-    if np.sum(sigma) > 0:
-        for tp in np.unique(types):
-            if tp == 0:
-                continue
-            imnew[types == tp] = colormap[tp]
-        imnew[bim] = border_color
+        # resize sigma and tau
+        sigma = _upscale(sigma, scale)
+        types = _upscale(tau, scale)
+
+        # color cells by cell type and draw the borders retrieved with mahotas
+        imnew = _palette(colormap, types)[types]
+        if draw_border:
+            imnew[labeled.borders(sigma)] = border_color
+        canvas = Canvas(Image.fromarray(imnew))
 
     # save final image
-    final_im = Image.fromarray(np.uint8(imnew))
-    final_im.save(fn)
+    if fn is not None:
+        canvas.save(fn)
+    return canvas
+
+
+def draw_cpm_grids(frames, colormap, fn_pattern, scale=1, border_color=None, draw_border=True, processes=None,
+                   max_pending=None):
+    """ Draw a series of cpm grids in parallel
+
+    Frames are drawn with draw_cpm_grid in a pool of worker processes. At most max_pending frames are in flight
+    at any time, so frames can be read lazily from disk, and frame i is always saved as fn_pattern.format(i).
+
+    :param frames: iterable with (sigma, tau) tuples, or a SnapshotStore
+    :param colormap: dictionary with tau as keys and colors (rgb tuples) as values
+    :param fn_pattern: filename pattern with a format field for the frame number, e.g. 'frame_{:05d}.png'
+    :param scale: image scaling
+    :param border_color: color of the cell borders
+    :param draw_border: draw cell borders
+    :param processes: number of worker processes (defaults to the number of cores)
+    :param max_pending: maximum number of frames in flight (defaults to twice the number of processes)
+    :return: list with the time in seconds it took to draw each frame
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * processes
+    times = []
+    pending = deque()
+    # spawn workers, forking is unsafe once numba has started its thread pool
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for i, frame in enumerate(frames):
+            if len(pending) >= max_pending:
+                times.append(pending.popleft().result())
+            pending.append(executor.submit(_draw_frame, frame[0], frame[1], colormap, fn_pattern.format(i), scale,
+                                           border_color, draw_border))
+        while pending:
+            times.append(pending.popleft().result())
+    return times
+
+
+def _draw_frame(sigma, tau, colormap, fn, scale, border_color, draw_border):
+    start = time.perf_counter()
+    draw_cpm_grid(sigma, tau, colormap, fn, scale, border_color, draw_border)
+    return time.perf_counter() - start
+
+
+def draw_cpm_grid_tiled(sigma, tau, colormap, fn, scale=1, border_color=None, draw_border=True, band=256):
+    """ Draw a large cpm grid directly to disk in bands of rows
+
+    Gives the same image as draw_cpm_grid, but only one band of band rows of the output image is in memory at any
+    time. Each band is drawn with a one pixel halo, such that the cell borders are the same as for the whole image,
+    and is then appended to the output file: a PNG file written incrementally, or a tiled BigTIFF file (for a
+    filename ending in .tif or .tiff, requires tifffile).
+
+    :param sigma: array with cell ids
+    :param tau: array with cell types
+    :param colormap: dictionary with tau as keys and colors (rgb tuples) as values
+    :param fn: filename used for saving
+    :param scale: image scaling
+    :param border_color: color of the cell borders
+    :param draw_border: draw cell borders
+    :param band: number of image rows per band (and tile size for BigTIFF, rounded up to a multiple of 16)
+    """
+    if draw_border and labeled is None:
+        print('Drawing borders is only available when mahotas is installed!')
+        draw_border = False
+    if border_color is None:
+        border_color = (0, 0, 0)
+    rows = _upscale_index(sigma.shape[0], scale)
+    cols = _upscale_index(sigma.shape[1], scale)
+    # an empty grid is drawn in white, like draw_cpm_grid does
+    lut = _palette(colormap, tau) if np.any(sigma) else np.full((int(tau.max()) + 1, 3), 255, dtype=np.uint8)
+    if fn.lower().endswith(('.tif', '.tiff')):
+        if tifffile is None:
+            raise ImportError('writing tiled BigTIFF files requires tifffile')
+        band = -(-band // 16) * 16
+        bands = _draw_bands(sigma, tau, lut, rows, cols, border_color, draw_border, band)
+        with tifffile.TiffWriter(fn, bigtiff=True) as tif:
+            tif.write(_tiles(bands, band, len(cols)), shape=(len(rows), len(cols), lut.shape[1]), dtype=np.uint8,
+                      tile=(band, band), photometric='rgb' if lut.shape[1] == 3 else 'minisblack')
+    else:
+        with open(fn, 'wb') as f:
+            writer = _PNGWriter(f, len(cols), len(rows), lut.shape[1])
+            for rgb in _draw_bands(sigma, tau, lut, rows, cols, border_color, draw_border, band):
+                writer.write(rgb)
+            writer.close()
+
+
+def _draw_bands(sigma, tau, lut, rows, cols, border_color, draw_border, band):
+    """ Generate the image in bands of rows, each band is drawn with a one pixel halo for the borders """
+    for r0 in range(0, len(rows), band):
+        r1 = min(r0 + band, len(rows))
+        lo = max(r0 - 1, 0)
+        hi = min(r1 + 1, len(rows))
+        index = np.ix_(rows[lo:hi], cols)
+        rgb = lut[tau[index]]
+        if draw_border:
+            rgb[labeled.borders(sigma[index])] = border_color
+        yield rgb[r0 - lo:r1 - lo]
+
+
+def _tiles(bands, size, width):
+    """ Split bands of rows into (zero padded) square tiles, in row-major order """
+    for rgb in bands:
+        for c0 in range(0, width, size):
+            tile = rgb[:, c0:c0 + size]
+            if tile.shape[:2] != (size, size):
+                tile = np.pad(tile, ((0, size - tile.shape[0]), (0, size - tile.shape[1]), (0, 0)))
+            yield tile
+
+
+class _PNGWriter(object):
+    """ Write a PNG image row by row, every call to write adds a compressed IDAT chunk """
+
+    def __init__(self, f, width, height, channels, level=6):
+        self.f = f
+        self.compressor = zlib.compressobj(level)
+        color_type = {1: 0, 3: 2, 4: 6}[channels]
+        f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def write(self, rows):
+        # every row starts with filter type 0 (none)
+        rows = rows.reshape(rows.shape[0], -1)
+        data = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        data[:, 0] = 0
+        data[:, 1:] = rows
+        self._chunk(b'IDAT', self.compressor.compress(data.tobytes()))
+
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+
+
+def _palette(colormap, tau):
+    """ Build uint8 lookup table with a color for each cell type, unknown cell types get the color of tau=0 """
+    lut = np.empty((max(max(colormap), int(tau.max())) + 1, len(colormap[0])), dtype=np.uint8)
+    lut[:] = colormap[0]
+    for tp, color in colormap.items():
+        lut[tp] = color
+    return lut
+
+
+def _upscale(a, scale):
+    """ Magnify 2D array with nearest-neighbour scaling """
+    if scale == int(scale):
+        scale = int(scale)
+        nx, ny = a.shape
+        return np.broadcast_to(a[:, None, :, None], (nx, scale, ny, scale)).reshape(nx * scale, ny * scale)
+    rows = _nearest_index(a.shape[0], int(scale * a.shape[0]))
+    cols = _nearest_index(a.shape[1], int(scale * a.shape[1]))
+    return a[np.ix_(rows, cols)]
+
+
+def _upscale_index(n, scale):
+    """ Source index of each output pixel when magnifying n pixels, consistent with _upscale """
+    if scale == int(scale):
+        return np.arange(n * int(scale)) // int(scale)
+    return _nearest_index(n, int(scale * n))
+
+
+def _nearest_index(n, m):
+    """ Source index of each of m output pixels when resizing n pixels with PIL's nearest-neighbour sampling """
+    index = Image.fromarray(np.arange(n, dtype=np.int32)[None, :]).resize((m, 1), Image.NEAREST)
+    return np.asarray(index)[0].astype(np.int64)
+
+
+class Canvas(object):
+    """ In-memory image that can be annotated
+
+    All annotation methods modify the image in memory and return the canvas itself, such that annotations can be
+    chained and the image is only encoded once when it is saved:
+
+    >>> draw_cpm_grid(sigma, tau, colormap).add_legend(colormap).add_text('t = 100', (.5, 1)).save('frame.png')
+
+    :param image: PIL image
+    """
+
+    def __init__(self, image):
+        self.image = image
+
+    @classmethod
+    def open(cls, fn):
+        """ Load canvas from an image file
+
+        :param fn: image filename
+        """
+        image = Image.open(fn)
+        image.load()
+        return cls(image)
+
+    def save(self, fn):
+        """ Save image
+
+        :param fn: filename
+        """
+        self.image.save(fn)
+        return self
+
+    def add_text(self, label, position, dist=10, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
+                 fontpath=__FONTPATH__, fontsize=14):
+        """ Add text to the image
+
+        :param label: text
+        :param position: relative (x, y) position of the text, with (0, 0) the bottom left corner
+        :param dist: distance to the border of the image
+        :param fontcolor: font color (r,g,b)
+        :param bgcolor: background color (r,g,b)
+        :param fontpath: path to font
+        :param fontsize: font size
+        """
+        (w, h) = self.image.size
+        text = _text_image(label, fontcolor, bgcolor, fontpath, fontsize)
+        (tw, th) = text.size
+        (x0, y0) = (dist, dist)
+        if position[0] == 1:
+            x0 = w - dist - tw
+        elif position[0] > 0:
+            x0 = w * position[0] - .5 * tw - .5 * dist
+        if 1 - position[1] == 1:
+            y0 = h - dist - th
+        elif position[1] < 1:
+            y0 = h * position[1] - .5 * th - .5 * dist
+        self.image.paste(text, (int(x0), int(y0)))
+        return self
+
+    def add_box(self, center, width, height, line_color):
+        """ Draw rectangle on the image
+
+        :param center: center of the rectangle
+        :param width: width of the rectangle
+        :param height: height of the rectangle
+        :param line_color: line color (r,g,b)
+        """
+        draw = ImageDraw.Draw(self.image)
+        draw.rectangle([(center[0] - .5 * width, center[1] - .5 * height),
+                        (center[0] + .5 * width, center[1] + .5 * height)], fill=None, outline=line_color)
+        return self
+
+    def add_text_outside(self, label, xpos='center', ypos='bottom', pad=10, fontcolor=(0, 0, 0),
+                         bgcolor=(255, 255, 255), fontpath=__FONTPATH__, fontsize=14):
+        """ Add text above or below the image
+
+        :param label: text
+        :param xpos: horizontal position ('left', 'center' or 'right')
+        :param ypos: vertical position ('top' or 'bottom')
+        :param pad: padding around the text
+        :param fontcolor: font color (r,g,b)
+        :param bgcolor: background color (r,g,b)
+        :param fontpath: path to font
+        :param fontsize: font size
+        """
+        (w, h) = self.image.size
+        text = _text_image(label, fontcolor, bgcolor, fontpath, fontsize)
+        (tw, th) = text.size
+        newim = Image.new('RGB', (w, h + th + 2 * pad), bgcolor)
+        (x0, y0) = (pad, pad)
+        if ypos == 'bottom':
+            y0 = h + pad
+            newim.paste(self.image, (0, 0))
+        else:
+            newim.paste(self.image, (0, th + 2 * pad))
+        if xpos == 'center':
+            x0 = .5 * (w - tw - pad)
+        elif xpos == 'right':
+            x0 = w - tw - pad
+        newim.paste(text, (int(x0), int(y0)))
+        self.image = newim
+        return self
+
+    def add_legend(self, colormap, wbox=10, hbox=10, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
+                   fontpath=__FONTPATH__, fontsize=14, overlay=False):
+        """ Add legend with the cell types to the image
+
+        :param colormap: dictionary with tau as keys and colors (rgb tuples) as values
+        :param wbox: width of the color boxes
+        :param hbox: height of the color boxes
+        :param fontcolor: font color (r,g,b)
+        :param bgcolor: background color (r,g,b)
+        :param fontpath: path to font
+        :param fontsize: font size
+        :param overlay: draw the legend on top of the image instead of next to it
+        """
+        font = _get_font(fontpath, fontsize)
+        x0 = 10
+        y0 = 10
+        dh = hbox + 5
+        # compute size of the legend
+        labelsizes = np.array([_text_size(str(key), fontpath, fontsize) for key in colormap.keys()])
+        th = labelsizes[0, 1]
+        h = y0 + len(colormap) * dh
+        w = x0 + max(labelsizes[:, 0]) + wbox + 5
+        # create image for legend and draw legend
+        legend = Image.new('RGB', (int(w), int(h)), bgcolor)
+        draw = ImageDraw.Draw(legend)
+        for i, (name, color) in enumerate(colormap.items()):
+            draw.rectangle([(x0, y0 + i * dh), (x0 + wbox, y0 + i * dh + hbox)], fill=color, outline=(0, 0, 0))
+            draw.text((x0 + wbox + 5, y0 + i * dh + .5 * hbox - .5 * th), str(name), fill=fontcolor, font=font)
+
+        # combine existing image and legend
+        if overlay:
+            self.image.paste(legend, (0, 0))
+        else:
+            newim = Image.new('RGB', (self.image.size[0] + legend.size[0], self.image.size[1]), color=bgcolor)
+            newim.paste(legend, (0, 0))
+            newim.paste(self.image, (legend.size[0], 0))
+            self.image = newim
+        return self
+
+    def add_color_bar(self, colors, labels, w, h, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
+                      fontpath=__FONTPATH__, fontsize=24, horizontal=False, append=False):
+        """ Add colorbar to the image
+
+        :param colors: list of colors
+        :param labels: list of labels
+        :param w: width of the colorbar
+        :param h: height of the colorbar
+        :param fontcolor: font color (r,g,b)
+        :param bgcolor: background color (r,g,b)
+        :param fontpath: path to font
+        :param fontsize: font size
+        :param horizontal: draw a horizontal instead of a vertical colorbar
+        :param append: add the colorbar next to the image instead of on top of it
+        """
+        if horizontal:
+            self.image = _add_color_bar_horizontal(self.image, colors, w, h, labels, fontcolor, bgcolor, fontpath,
+                                                   fontsize, append)
+        else:
+            self.image = _add_color_bar_vertical(self.image, colors, w, h, labels, fontcolor, bgcolor, fontpath,
+                                                 fontsize, append)
+        return self
+
+
+@functools.lru_cache(maxsize=None)
+def _get_font(fontpath, fontsize):
+    return ImageFont.truetype(fontpath, fontsize)
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_size(label, fontpath, fontsize):
+    left, top, right, bottom = _get_font(fontpath, fontsize).getbbox(label)
+    return right, bottom
+
+
+def _text_image(label, fontcolor, bgcolor, fontpath, fontsize):
+    text = Image.new('RGBA', _text_size(label, fontpath, fontsize), bgcolor)
+    draw = ImageDraw.Draw(text)
+    draw.text((0, 0), label, font=_get_font(fontpath, fontsize), fill=fontcolor)
+    return text
 
 
 def add_text(imname, label, position, dist=10, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
              fontpath=__FONTPATH__, fontsize=14, outname=None):
-    font = ImageFont.truetype(fontpath, fontsize)
-    im = Image.open(imname)
-    (w, h) = im.size
-    temp = Image.new('RGBA', (w, h), bgcolor)
-    draw = ImageDraw.Draw(temp)
-    (tw, th) = draw.textsize(label, font=font)
-    text = Image.new('RGBA', (tw, th), bgcolor)
-    draw = ImageDraw.Draw(text)
-    draw.text((0, 0), label, font=font, fill=fontcolor)
-    (x0, y0) = (dist, dist)
-    if position[0] == 1:
-        x0 = w - dist - tw
-    elif position[0] > 0:
-        x0 = w * position[0] - .5 * tw - .5 * dist
-    if 1 - position[1] == 1:
-        y0 = h - dist - th
-    elif position[1] < 1:
-        y0 = h * position[1] - .5 * th - .5 * dist
-    im.paste(text, (int(x0), int(y0)))
-    im.save(imname)
-
-def add_box(imname, center, width, height, line_color):
-    im = Image.open(imname)
-    draw = ImageDraw.Draw(im)
-    draw.rectangle([(center[0]-.5*width,center[1]-.5*height),
-                    (center[0]+.5*width,center[1]+.5*height)],fill=None,outline=line_color)
+    Canvas.open(imname).add_text(label, position, dist, fontcolor, bgcolor, fontpath, fontsize).save(
+        outname or imname)
 
-def add_text_outside(imname, label, xpos='center', ypos='bottom', pad=10, fontcolor=(0, 0, 0),
-                    bgcolor=(255, 255, 255), fontpath=__FONTPATH__, fontsize=14, outname=None):
 
-    font = ImageFont.truetype(fontpath, fontsize)
-    im = Image.open(imname)
-    (w, h) = im.size
-    temp = Image.new('RGBA', (w, h), bgcolor)
-    draw = ImageDraw.Draw(temp)
-    (tw, th) = draw.textsize(label, font=font)
+def add_box(imname, center, width, height, line_color, outname=None):
+    Canvas.open(imname).add_box(center, width, height, line_color).save(outname or imname)
 
-    text = Image.new('RGBA', (tw, th), bgcolor)
-    draw = ImageDraw.Draw(text)
-    draw.text((0, 0), label, font=font, fill=fontcolor)
 
-    newim = Image.new('RGB', (im.size[0],im.size[1]+th+2*pad), bgcolor)
-    (x0, y0) = (pad,pad)
-    if ypos == 'bottom':
-        y0 = h+pad
-    if xpos == 'center':
-        x0 = .5*(w-tw-pad)
-    elif xpos == 'right':
-        x0 = w-th-pad
-    newim.paste(im, (0,0))
-    newim.paste(text, (x0,y0))
-    newim.save(imname)
+def add_text_outside(imname, label, xpos='center', ypos='bottom', pad=10, fontcolor=(0, 0, 0),
+                     bgcolor=(255, 255, 255), fontpath=__FONTPATH__, fontsize=14, outname=None):
+    Canvas.open(imname).add_text_outside(label, xpos, ypos, pad, fontcolor, bgcolor, fontpath, fontsize).save(
+        outname or imname)
 
 
 def add_legend(imname, colormap, wbox=10, hbox=10, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
                fontpath=__FONTPATH__, fontsize=14, outname=None, overlay=False):
-    font = ImageFont.truetype(fontpath, fontsize)
-    x0 = 10
-    y0 = 10
-    dh = hbox + 5
-    # open image to which the legend is added
-    im = Image.open(imname)
-    # compute size of the legend
-    (w, h) = im.size
-    temp = Image.new('RGB', (10, 10))
-    draw = ImageDraw.Draw(temp)
-    labelsizes = np.array([draw.textsize(str(key), font=font) for key in colormap.keys()])
-    th = labelsizes[0, 1]
-    (tw, th) = draw.textsize(str(list(colormap.keys())[0]), font=font)
-    h = y0 + len(colormap) * dh
-    w = x0 + max(labelsizes[:, 0]) + wbox + 5
-    # create image for legend and draw legend
-    legend = Image.new('RGB', (w, h), bgcolor)
-    draw = ImageDraw.Draw(legend)
-    for i, (name, color) in enumerate(colormap.items()):
-        draw.rectangle([(x0, y0 + i * dh), (x0 + wbox, y0 + i * dh + hbox)], fill=color, outline=(0, 0, 0))
-        draw.text((x0 + wbox + 5, y0 + i * dh + .5 * hbox - .5 * th), str(name), fill=fontcolor, font=font)
-
-    # combine existing image and legend
-    if outname is None:
-        outname = imname
-    if overlay:
-        im.paste(legend, (0, 0))
-        im.save(outname)
-    else:
-        newim = Image.new('RGB', (im.size[0] + legend.size[0], im.size[1]), color=bgcolor)
-        newim.paste(legend, (0, 0))
-        newim.paste(im, (legend.size[0], 0))
-        newim.save(outname)
+    Canvas.open(imname).add_legend(colormap, wbox, hbox, fontcolor, bgcolor, fontpath, fontsize, overlay).save(
+        outname or imname)
 
 
 def add_color_bar(imname, colors, labels, w, h, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255), fontpath=__FONTPATH__,
@@ -221,26 +607,19 @@ def add_color_bar(imname, colors, labels, w, h, fontcolor=(0, 0, 0), bgcolor=(25
     :param fontsize: font size
     :param outname: name of the new image
     """
-    im = Image.open(imname)
-    if horizontal:
-        im = _add_color_bar_horizontal(im, colors, w, h, labels, fontcolor, bgcolor, fontpath, fontsize, append)
-    else:
-        im = _add_color_bar_vertical(im, colors, w, h, labels, fontcolor, bgcolor, fontpath, fontsize, append)
-    if outname is None:
-        im.save(imname)
-    else:
-        im.save(outname)
+    Canvas.open(imname).add_color_bar(colors, labels, w, h, fontcolor, bgcolor, fontpath, fontsize, horizontal,
+                                      append).save(outname or imname)
 
 
 def _add_color_bar_vertical(im, colors, w, h, labels=None, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
                             fontpath=__FONTPATH__, fontsize=24, append=False):
+    W = w
+    H = h
     if labels is not None:
-        font = ImageFont.truetype(fontpath, fontsize)
+        font = _get_font(fontpath, fontsize)
         lablen = [len(label) for label in labels]
         lbig = labels[lablen.index(max(lablen))]
-        temp = Image.new('RGB', (10, 10))
-        draw = ImageDraw.Draw(temp)
-        tsize = draw.textsize(str(lbig), font=font)
+        tsize = _text_size(str(lbig), fontpath, fontsize)
         H = h + tsize[1]
         W = w + 1.1 * tsize[0] + 10
     nx = int(math.ceil(W))
@@ -251,7 +630,7 @@ def _add_color_bar_vertical(im, colors, w, h, labels=None, fontcolor=(0, 0, 0),
     y0 = ny - (ny - h) / 2.
     for idx, c in enumerate(colors):
         color = tuple(int(255 * c[i]) for i in [0, 1, 2])
-        draw.rectangle([(0, y0 - idx * dh), (w, y0 - (idx + 1) * dh)], fill=color, outline=color)
+        draw.rectangle([(0, y0 - (idx + 1) * dh), (w, y0 - idx * dh)], fill=color, outline=color)
     if labels is not None:
         x = w + 0.1 * tsize[0]
         for i, label in enumerate(labels):
@@ -269,13 +648,13 @@ def _add_color_bar_vertical(im, colors, w, h, labels=None, fontcolor=(0, 0, 0),
 
 def _add_color_bar_horizontal(im, colors, w, h, labels=None, fontcolor=(0, 0, 0), bgcolor=(255, 255, 255),
                               fontpath=__FONTPATH__, fontsize=24, append=False):
+    W = w
+    H = h
     if labels is not None:
-        font = ImageFont.truetype(fontpath, fontsize)
+        font = _get_font(fontpath, fontsize)
         lablen = [len(label) for label in labels]
         lbig = labels[lablen.index(max(lablen))]
-        temp = Image.new('RGB', (10, 10))
-        draw = ImageDraw.Draw(temp)
-        tsize = draw.textsize(str(lbig), font=font)
+        tsize = _text_size(str(lbig), fontpath, fontsize)
         H = h + 1.1*tsize[1]+10
         W = w + 1.1 * tsize[0] - 10
     nx = int(math.ceil(W))
@@ -290,7 +669,6 @@ def _add_color_bar_horizontal(im, colors, w, h, labels=None, fontcolor=(0, 0, 0)
     if labels is not None:
         y = h
         for i, label in enumerate(labels):
-            tsize = draw.textsize(str(lbig), font=font)
             x = x0 + -.5 * tsize[0] + w * i / float(len(labels) - 1)
             draw.text((x, y), str(label), fill=fontcolor, font=font)
     if append:
@@ -299,5 +677,5 @@ def _add_color_bar_horizontal(im, colors, w, h, labels=None, fontcolor=(0, 0, 0)
         newim.paste(barim, (int((im.size[0] - nx) // 2), int(10+im.size[1])))
         return newim
     else:
-        im.paste(barim, ((im.size[0] - nx) - nx / 2, (im.size[1] - ny) / 2))
+        im.paste(barim, ((im.size[0] - nx) - nx // 2, (im.size[1] - ny) // 2))
         return im
@@ -1,7 +1,9 @@
-import future        # pip install future
 import matplotlib.pyplot as plt
 import numpy as np
 import copy,os
+import queue
+import threading
+import time
 import matplotlib.colors as mpl_colors
 import matplotlib.animation as animation
 
@@ -9,7 +11,7 @@ import matplotlib.animation as animation
 def animate_cpm_sim_mpl(tau_list,colors,fn=None,show=False,dpi=100,scale=1,fps=5):
     """ Animate cpm simulation using matplotlib
 
-    :param tau_list: list of grids with tau
+    :param tau_list: list of grids with tau, or a SnapshotStore
     :param colors: list of matplotlib colornames, in the order of tau (see https://matplotlib.org/examples/color/named_colors.html)
     :param fn: filename used for saving the video
     :param show: show animation
@@ -18,14 +20,15 @@ def animate_cpm_sim_mpl(tau_list,colors,fn=None,show=False,dpi=100,scale=1,fps=5
     :param fps: animation frame rate
     """
 
+    if hasattr(tau_list, 'tau'):
+        tau_list = tau_list.tau
+
     # setup figure
     fig = plt.figure(figsize=(scale * tau_list[0].shape[0] / 100., scale * tau_list[0].shape[1] / 100.),dpi=dpi)
     ax = plt.gca()
 
     # setup colormap
-    cmap = mpl_colors.ListedColormap(colors)
-    bounds = np.arange(0, 7)
-    norm = mpl_colors.BoundaryNorm(bounds, cmap.N)
+    cmap, norm = _cpm_colormap(colors)
 
     # create images
     ims = []
@@ -45,6 +48,55 @@ def animate_cpm_sim_mpl(tau_list,colors,fn=None,show=False,dpi=100,scale=1,fps=5
     return anim
 
 
+def stream_cpm_sim_mpl(tau_frames, colors, fn, dpi=100, scale=1, fps=5, writer=None):
+    """ Stream cpm simulation to a video file using matplotlib
+
+    In contrast to animate_cpm_sim_mpl, frames are not kept in memory: a single image is updated for
+    every frame and directly passed on to the encoder, such that tau_frames can be a generator.
+
+    :param tau_frames: iterable with grids with tau, or a SnapshotStore
+    :param colors: list of matplotlib colornames, in the order of tau (see https://matplotlib.org/examples/color/named_colors.html)
+    :param fn: filename used for saving the video
+    :param dpi: dpi
+    :param scale: scaling factor
+    :param fps: animation frame rate
+    :param writer: matplotlib movie writer (defaults to ffmpeg with libx264)
+    :return: number of frames written
+    """
+    if hasattr(tau_frames, 'tau'):
+        tau_frames = tau_frames.tau
+    frames = iter(tau_frames)
+    tau = next(frames)
+
+    # setup figure
+    fig = plt.figure(figsize=(scale * tau.shape[0] / 100., scale * tau.shape[1] / 100.), dpi=dpi)
+    ax = plt.gca()
+    cmap, norm = _cpm_colormap(colors)
+    im = plt.imshow(tau, interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
+    ax.set_aspect('equal', adjustable='box')
+    plt.axis('off')
+
+    # write frames
+    if writer is None:
+        writer = animation.FFMpegWriter(fps=fps, codec='libx264')
+    n = 1
+    with writer.saving(fig, fn, dpi):
+        writer.grab_frame()
+        for tau in frames:
+            im.set_data(tau)
+            writer.grab_frame()
+            n += 1
+    plt.close(fig)
+    return n
+
+
+def _cpm_colormap(colors):
+    """ Colormap and norm that map tau = i to colors[i] """
+    cmap = mpl_colors.ListedColormap(colors)
+    norm = mpl_colors.BoundaryNorm(np.arange(0, len(colors) + 1), cmap.N)
+    return cmap, norm
+
+
 def draw_cpm_grid_mpl(tau,colors,ax=None,fn=None,dpi=100,scale=1):
     """ Draw cpm grid using matplotlib.
 
@@ -79,3 +131,186 @@ def draw_cpm_grid_mpl(tau,colors,ax=None,fn=None,dpi=100,scale=1):
     if fn is not None:
         plt.savefig(fn,dpi=dpi)
         plt.close()
+
+
+class LiveViewer(object):
+    """ Live view of a running cpm simulation
+
+    The figure and image are set up once; every new frame is colored with a single lookup in a uint8 RGBA table
+    (which avoids matplotlib's norm and colormap) and replaces the image data, which is redrawn with blitting when
+    the backend supports it. Frames can come from a queue filled by another thread or process, or from a generator
+    that is run in a background thread. When frames arrive faster than they can be drawn, only the most recent frame
+    is shown and the others are dropped.
+
+    >>> viewer = LiveViewer(['white', 'red', 'blue'])
+    >>> viewer.run(simulation_frames())
+
+    :param colors: list of matplotlib colornames, in the order of tau (see https://matplotlib.org/examples/color/named_colors.html)
+    :param scale: scaling factor
+    :param dpi: dpi
+    """
+
+    def __init__(self, colors, scale=1, dpi=100):
+        self.lut = (mpl_colors.to_rgba_array(colors) * 255).round().astype(np.uint8)
+        self.scale = scale
+        self.dpi = dpi
+        self.fig = None
+
+    def _setup(self, tau):
+        self.fig = plt.figure(figsize=(self.scale * tau.shape[0] / 100., self.scale * tau.shape[1] / 100.),
+                              dpi=self.dpi)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.im = self.ax.imshow(self._rgba(tau), interpolation='none', origin='lower', animated=True)
+        self.label = self.ax.text(0.01, 0.99, '', transform=self.ax.transAxes, va='top', animated=True)
+        plt.show(block=False)
+        # the background (everything except the animated artists) is captured on every full redraw
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.fig.canvas.draw()
+
+    def _rgba(self, tau):
+        # unknown cell types get the color of the last type, like with the colormap of animate_cpm_sim_mpl
+        return np.take(self.lut, tau, axis=0, mode='clip')
+
+    def _on_draw(self, event):
+        self._background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.ax.draw_artist(self.im)
+        self.ax.draw_artist(self.label)
+
+    @property
+    def is_open(self):
+        """ False once the window has been closed """
+        return self.fig is not None and plt.fignum_exists(self.fig.number)
+
+    def update(self, frame):
+        """ Show a frame
+
+        :param frame: grid with tau, or a (sigma, tau) or (sigma, tau, mcs) tuple as given by a SnapshotStore
+        """
+        mcs = None
+        if isinstance(frame, tuple):
+            tau = frame[1]
+            if len(frame) > 2:
+                mcs = frame[2]
+        else:
+            tau = frame
+        if self.fig is None:
+            self._setup(tau)
+        self.im.set_data(self._rgba(tau))
+        self.label.set_text('' if mcs is None else 'MCS {}'.format(mcs))
+        canvas = self.fig.canvas
+        if canvas.supports_blit:
+            canvas.restore_region(self._background)
+            self.ax.draw_artist(self.im)
+            self.ax.draw_artist(self.label)
+            canvas.blit(self.fig.bbox)
+        else:
+            canvas.draw_idle()
+        canvas.flush_events()
+
+    def run(self, frames, fps=None):
+        """ Show frames until the source is exhausted or the window is closed
+
+        :param frames: queue.Queue (or multiprocessing queue) with frames, ended by putting None, or any iterable
+            with frames (see update)
+        :param fps: maximum frame rate (no limit when None)
+        :return: number of frames shown and number of frames dropped
+        """
+        if hasattr(frames, 'get_nowait'):
+            source = self._from_queue(frames)
+        else:
+            source = self._from_iterable(frames)
+        shown = 0
+        dropped = 0
+        last = 0.
+        try:
+            for frame, skipped in source:
+                if fps is not None:
+                    time.sleep(max(0., last + 1. / fps - time.perf_counter()))
+                    last = time.perf_counter()
+                self.update(frame)
+                shown += 1
+                dropped += skipped
+                if not self.is_open:
+                    break
+        finally:
+            source.close()
+        return shown, dropped
+
+    def _idle(self):
+        # keep the window responsive while waiting for frames
+        if self.fig is not None:
+            self.fig.canvas.flush_events()
+
+    def _closed(self):
+        return self.fig is not None and not self.is_open
+
+    def _from_queue(self, q):
+        """ Yield the most recent frame in the queue and the number of older frames that were skipped """
+        while not self._closed():
+            try:
+                frame = q.get(timeout=0.05)
+            except queue.Empty:
+                self._idle()
+                continue
+            if frame is None:
+                return
+            skipped = 0
+            while True:
+                try:
+                    newer = q.get_nowait()
+                except queue.Empty:
+                    break
+                if newer is None:
+                    yield frame, skipped
+                    return
+                frame = newer
+                skipped += 1
+            yield frame, skipped
+
+    def _from_iterable(self, frames):
+        """ Run the iterable in a background thread and yield its most recent frame and the number of skipped frames """
+        slot = {'frame': None, 'count': 0, 'done': False, 'error': None}
+        changed = threading.Condition()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for frame in frames:
+                    with changed:
+                        slot['frame'] = frame
+                        slot['count'] += 1
+                        changed.notify()
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                slot['error'] = e
+            finally:
+                with changed:
+                    slot['done'] = True
+                    changed.notify()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        seen = 0
+        try:
+            while not self._closed():
+                with changed:
+                    changed.wait_for(lambda: slot['count'] > seen or slot['done'], timeout=0.05)
+                    count, frame, done = slot['count'], slot['frame'], slot['done']
+                if count > seen:
+                    yield frame, count - seen - 1
+                    seen = count
+                elif done:
+                    if slot['error'] is not None:
+                        raise slot['error']
+                    return
+                else:
+                    self._idle()
+        finally:
+            stop.set()
+
+    def close(self):
+        """ Close the window """
+        if self.fig is not None:
+            plt.close(self.fig)